@@ -0,0 +1,68 @@
+"""
+Compares the encode/decode throughput of message payloads:
+
+- xml+json: TCPMessage.to_xml of a JSON payload, read back with parse_message (the original path)
+- frame+json: TCPMessage.to_frame of a JSON payload, read back with decode_payload
+- frame+binary: TCPMessage.to_frame of a core.codec payload, read back with decode_payload
+
+Usage: python -m benchmarks.payload_formats
+"""
+import json
+import time
+
+from core import codec
+from core.utils import BINARY_FORMAT, FRAME_HEADER, TCPMessage, decode_payload, parse_message
+
+REPEAT = 5
+
+
+def xml_json(obj):
+    encoded = TCPMessage('query', 'json', json.dumps(obj)).to_xml()
+    return encoded, lambda: parse_message(encoded).payload
+
+
+def frame_json(obj):
+    encoded = TCPMessage('query', 'json', json.dumps(obj)).to_frame()
+    return encoded, lambda: decode_payload('json', memoryview(encoded)[FRAME_HEADER.size + len('queryjson'):])
+
+
+def frame_binary(obj):
+    encoded = TCPMessage('query', BINARY_FORMAT, codec.encode(obj)).to_frame()
+    offset = FRAME_HEADER.size + len('query' + BINARY_FORMAT)
+    return encoded, lambda: decode_payload(BINARY_FORMAT, memoryview(encoded)[offset:])
+
+
+def best_time(func):
+    best = float('inf')
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    file_names = [f'APAC_AUS_{i:07d}_part-{i % 17:05d}.parquet' for i in range(200000)]
+    payloads = {
+        'query result, 200k file names': file_names,
+        'row group result, 20k files': [[name, [0, 3, 7]] for name in file_names[:20000]],
+        'query_batch request, 1k queries': {'queries': [
+            {'store': 'store_name', 'query': {'condition': 'and', 'rules': [
+                {'field': 'account_status', 'value': 'Inactive'},
+                {'field': 'amount', 'operator': 'between', 'value': [i, i + 1000]}]}}
+            for i in range(1000)]},
+    }
+
+    for name, obj in payloads.items():
+        print(name)
+        for label, path in (('xml+json', xml_json), ('frame+json', frame_json), ('frame+binary', frame_binary)):
+            encoded, decode = path(obj)
+            encode_time = best_time(lambda: path(obj))
+            decode_time = best_time(decode)
+            assert decode() == obj
+            print(f'  {label:<13} {len(encoded) / 1e6:7.2f} MB  encode {encode_time * 1e3:8.1f} ms  '
+                  f'decode {decode_time * 1e3:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
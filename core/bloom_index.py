@@ -0,0 +1,130 @@
+import json
+import math
+import mmap
+from pathlib import Path
+
+import numpy as np
+from pybloom_live.pybloom import make_hashfuncs
+
+from core.segment import PREFIX, align, replace_atomically
+
+BLOOM_INDEX_SUFFIX = '.bsi'
+BLOOM_INDEX_MAGIC = b'PBSI'
+BLOOM_INDEX_VERSION = 1
+
+
+class BitSlicedBloomIndex:
+    """
+    Bloom filters of one column across all the files of a store, stored bit-sliced.
+
+    Every file uses the same size and hash functions, and the bits are laid out as a matrix of
+    bit positions x files (packed 8 files per byte). Testing a value reads the k rows selected by its
+    hashes and ANDs them together, which yields the bitmap of candidate files in one operation.
+    """
+
+    def __init__(self, files, matrix, num_slices, bits_per_slice, error_rate=0.1, data_type='str', capacity=None):
+        self.files = list(files)
+        self.file_set = set(self.files)
+        self.matrix = matrix
+        self.num_slices = num_slices
+        self.bits_per_slice = bits_per_slice
+        self.error_rate = error_rate
+        self.data_type = data_type
+        self.capacity = capacity
+        self.make_hashes, _ = make_hashfuncs(num_slices, bits_per_slice)
+        self._offsets = np.arange(num_slices) * bits_per_slice
+
+    @staticmethod
+    def sizing(capacity, error_rate):
+        """Returns (num_slices, bits_per_slice), the same sizing as pybloom_live.BloomFilter"""
+        num_slices = int(math.ceil(math.log(1.0 / error_rate, 2)))
+        bits_per_slice = int(math.ceil((capacity * abs(math.log(error_rate))) / (num_slices * (math.log(2) ** 2))))
+        return num_slices, bits_per_slice
+
+    @classmethod
+    def build(cls, values_by_file, error_rate=0.1, data_type='str', capacity=None, base=None, base_files=()):
+        """
+        Builds the index from a {file: unique values} mapping, sized for the file with the most values
+        unless capacity is given.
+
+        The files of base_files are copied from base, an existing index that must have the same sizing,
+        so unchanged files do not need to be read again.
+        """
+        files = sorted(set(values_by_file) | set(base_files))
+        if capacity is None:
+            capacity = max([len(values) for values in values_by_file.values()] + [1])
+        num_slices, bits_per_slice = cls.sizing(capacity, error_rate)
+        if base_files and (base.num_slices, base.bits_per_slice) != (num_slices, bits_per_slice):
+            raise ValueError('The base index does not have the same sizing')
+
+        index = cls(files, None, num_slices, bits_per_slice, error_rate, data_type, capacity)
+        matrix = np.zeros((num_slices * bits_per_slice, (len(files) + 7) // 8), dtype=np.uint8)
+        base_positions = {file: position for position, file in enumerate(base.files)} if base_files else {}
+        for position, file in enumerate(files):
+            byte, bit = divmod(position, 8)
+            if file in values_by_file:
+                for value in values_by_file[file]:
+                    matrix[index._rows(value), byte] |= np.uint8(0x80 >> bit)
+            else:
+                base_byte, base_bit = divmod(base_positions[file], 8)
+                column = (base.matrix[:, base_byte] >> (7 - base_bit)) & 1
+                matrix[:, byte] |= column << (7 - bit)
+        index.matrix = matrix
+        return index
+
+    def _rows(self, value):
+        return self._offsets + np.fromiter(self.make_hashes(value), dtype=np.int64, count=self.num_slices)
+
+    def candidate_mask(self, value):
+        """Returns a boolean array over self.files, True where the file may contain value"""
+        packed = np.bitwise_and.reduce(self.matrix[self._rows(value)], axis=0)
+        return np.unpackbits(packed, count=len(self.files)).astype(bool)
+
+    def candidate_mask_any(self, values):
+        """Returns a boolean array over self.files, True where the file may contain any of values"""
+        packed = np.zeros(self.matrix.shape[1], dtype=np.uint8)
+        for value in values:
+            packed |= np.bitwise_and.reduce(self.matrix[self._rows(value)], axis=0)
+        return np.unpackbits(packed, count=len(self.files)).astype(bool)
+
+    def candidates(self, value):
+        """Returns the names of the files that may contain value"""
+        return [self.files[position] for position in np.flatnonzero(self.candidate_mask(value))]
+
+    def save(self, path):
+        header = json.dumps({
+            'files': self.files,
+            'num_slices': self.num_slices,
+            'bits_per_slice': self.bits_per_slice,
+            'error_rate': self.error_rate,
+            'data_type': self.data_type,
+            'capacity': self.capacity,
+            'shape': list(self.matrix.shape),
+        }).encode()
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with replace_atomically(path) as f:
+            f.write(PREFIX.pack(BLOOM_INDEX_MAGIC, BLOOM_INDEX_VERSION, len(header)))
+            f.write(header)
+            f.seek(align(PREFIX.size + len(header)))
+            f.write(np.ascontiguousarray(self.matrix).tobytes())
+
+    @classmethod
+    def load(cls, path):
+        """Memory-maps an index written by save, the matrix is a read-only view over the file"""
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, header_length = PREFIX.unpack_from(mapped, 0)
+        if magic != BLOOM_INDEX_MAGIC:
+            raise ValueError(f'{path} is not a bit-sliced bloom index')
+        if version != BLOOM_INDEX_VERSION:
+            raise ValueError(f'Unsupported bloom index version {version} in {path}')
+
+        header = json.loads(mapped[PREFIX.size:PREFIX.size + header_length])
+        rows, columns = header['shape']
+        matrix = np.frombuffer(mapped, dtype=np.uint8, count=rows * columns,
+                               offset=align(PREFIX.size + header_length)).reshape(rows, columns)
+        return cls(header['files'], matrix, header['num_slices'], header['bits_per_slice'],
+                   header['error_rate'], header['data_type'], header.get('capacity'))
@@ -1,34 +1,161 @@
 import json
 import asyncio
 import base64
+import itertools
+import logging
 import pickle
 
-from core.utils import TCPMessage
+from core import codec
+from core.utils import BINARY_FORMAT, FRAME_MAGIC, STREAM_END, TCPMessage, read_frame
+
+
+class PetalsConnection:
+    """
+    One keep-alive framed connection to the server.
+
+    Requests are written as soon as they are sent, without waiting for earlier responses: a background task
+    reads the response frames and resolves the future of their request id, or queues the frames of a
+    streamed response. The task stops reading while a stream consumer is STREAM_BUFFER chunks behind, which
+    holds back the server, and the other responses of the connection, until the consumer catches up.
+    """
+
+    STREAM_BUFFER = 8  # chunks of a streamed response received ahead of its consumer
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}  # request id -> future of the response payload
+        self.streams = {}  # request id -> queue of the frames of a streamed response
+        self.closed = False
+        self._drain_lock = asyncio.Lock()
+        self._reader_task = asyncio.create_task(self._read_responses())
+
+    @classmethod
+    async def open(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(FRAME_MAGIC)
+        return cls(reader, writer)
+
+    def send(self, request_id, message):
+        """Writes a request and returns the future of its response payload"""
+        if self.closed:
+            raise ConnectionResetError("Connection closed")
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.writer.write(message.to_frame(request_id))
+        return future
+
+    async def response(self, request_id, future):
+        try:
+            async with self._drain_lock:
+                await self.writer.drain()
+            return await future
+        finally:
+            self.pending.pop(request_id, None)
+
+    def send_stream(self, request_id, message):
+        """Writes a request answered by a streamed response and returns the queue receiving its frames"""
+        if self.closed:
+            raise ConnectionResetError("Connection closed")
+        queue = asyncio.Queue(self.STREAM_BUFFER)
+        self.streams[request_id] = queue
+        self.writer.write(message.to_frame(request_id))
+        return queue
+
+    async def next_chunk(self, queue, timeout):
+        """Returns the payload of the next chunk of a streamed response, None once the stream ended"""
+        async with self._drain_lock:
+            await self.writer.drain()
+        message = await asyncio.wait_for(queue.get(), timeout)
+        if isinstance(message, Exception):
+            raise message
+        if message.cls == STREAM_END:
+            if 'error' in message.payload:
+                raise RuntimeError(message.payload['error'])
+            return None
+        return message.payload
+
+    def end_stream(self, request_id):
+        """Stops queueing the frames of a stream, the remaining ones are dropped as they arrive"""
+        queue = self.streams.pop(request_id, None)
+        while queue is not None and not queue.empty():
+            # Unblocks the reader task if it waits for room in the queue
+            queue.get_nowait()
+
+    @property
+    def busy(self):
+        return len(self.pending) + len(self.streams)
+
+    async def _read_responses(self):
+        try:
+            while True:
+                request_id, message = await read_frame(self.reader)
+                queue = self.streams.get(request_id)
+                if queue is not None:
+                    await queue.put(message)
+                    continue
+                future = self.pending.get(request_id)
+                if future is not None and not future.done():
+                    future.set_result(message.payload)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+            self.close(ConnectionResetError(f"Connection lost: {e}"))
+
+    def close(self, error=None):
+        if self.closed:
+            return
+        self.closed = True
+        error = error or ConnectionResetError("Connection closed")
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+        for queue in self.streams.values():
+            if queue.full():
+                # The stream fails anyway, make room for the error
+                queue.get_nowait()
+            queue.put_nowait(error)
+        if asyncio.current_task() is not self._reader_task:
+            self._reader_task.cancel()
+        self.writer.close()
 
 
 class PetalsClient:
     """
     Represents a client for interacting with the Petals server.
 
-    The PetalsClient sends messages to the Petals server using a TCP connection.
-    It can send search queries to the server and receive responses.
+    The PetalsClient sends messages to the Petals server over a pool of keep-alive connections, using the
+    framed protocol. Concurrent requests are pipelined over the pooled connections and matched to their
+    responses by request id. It can send search queries to the server and receive responses.
 
     Attributes:
         host (str): The host address of the Petals server.
         port (int): The port number on which the Petals server is listening.
         retries (int): The number of retries to attempt in case of connection issues.
         timeout (float): The timeout for waiting for server responses.
+        pool_size (int): The maximum number of connections kept open to the server.
+        payload_format (str): The format of the messages built by the send_* helpers, 'json' or 'binary'.
 
     Methods:
         send_search_query(search_input: dict) -> list:
             Send a search query to the Petals server and receive a list of matching file paths.
 
+        send_query_batch(entries: list) -> list:
+            Send several search queries at once and receive the result of each one, in order.
+
+        stream_search_query(search_input: dict, chunk_size: int = None) -> async iterator of lists:
+            Send a search query and receive the matching file paths in chunks, as the server produces them.
+
+        send_kv_mget(keys) / send_kv_mset(items) / send_kv_mdelete(keys) -> dict:
+            Read, write or delete several keys of the server's key-value store in one message.
+
         send_message(message: TCPMessage) -> any:
             Send a TCPMessage to the Petals server and receive the server's response.
 
         parse_response(format: str, response_string: str) -> any:
             Parse the server's response based on the specified format.
 
+        close():
+            Close the pooled connections.
+
     Example:
         client = PetalsClient('127.0.0.1', 8888)
 
@@ -72,20 +199,66 @@ class PetalsClient:
             print(file_path)
     """
 
-    def __init__(self, host, port, retries=3, timeout=10):
+    def __init__(self, host, port, retries=3, timeout=10, pool_size=4, payload_format='json'):
         """
-        Initialize a PetalsClient object with the specified host, port, retries, and timeout.
+        Initialize a PetalsClient object with the specified host, port, retries, timeout and pool size.
 
         Args:
             host (str): The host address of the Petals server.
             port (int): The port number on which the Petals server is listening.
             retries (int, optional): The number of retries to attempt in case of connection issues. Default is 3.
             timeout (float, optional): The timeout for waiting for server responses in seconds. Default is 10.
+            pool_size (int, optional): The maximum number of pooled connections. Default is 4.
+            payload_format (str, optional): 'json', or 'binary' for the compact core.codec encoding of
+                requests and responses. Default is 'json'.
         """
+        if payload_format not in ('json', BINARY_FORMAT):
+            raise ValueError(f"Unexpected payload format: {payload_format}")
         self.host = host
         self.port = port
         self.retries = retries
         self.timeout = timeout
+        self.pool_size = pool_size
+        self.payload_format = payload_format
+        self._connections = []
+        self._connecting = 0
+        self._loop = None
+        self._request_ids = itertools.count(1)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        """Close the pooled connections, requests still waiting for a response fail"""
+        connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+            await connection.writer.wait_closed()
+
+    async def _get_connection(self):
+        """Returns the least busy pooled connection, opening a new one while the pool is not full"""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # Connections are bound to the event loop that opened them
+            self._loop = loop
+            self._connections = []
+            self._connecting = 0
+
+        self._connections = [connection for connection in self._connections if not connection.closed]
+        idle = min(self._connections, key=lambda connection: connection.busy, default=None)
+        if idle is not None and (not idle.busy or len(self._connections) + self._connecting >= self.pool_size):
+            return idle
+
+        self._connecting += 1
+        try:
+            connection = await asyncio.wait_for(PetalsConnection.open(self.host, self.port), timeout=self.timeout)
+        finally:
+            self._connecting -= 1
+        self._connections.append(connection)
+        return connection
 
     async def send_search_query(self, search_input):
         """
@@ -123,26 +296,105 @@ class PetalsClient:
             for file_path in matching_files:
                 print(file_path)
         """
-        # Convert the search_input dictionary to a JSON string
-        search_input_json = json.dumps(search_input)
-
-        # Create a message in XML format
-        message = TCPMessage("query", "json", search_input_json)
+        # Create a message in the payload format of the client
+        message = self.build_message("query", search_input)
 
         # Send the message to the server and receive the response
         response = await self.send_message(message)
 
-        # Response is a Python object (a list of file paths) decoded by parse_response
+        # Response is a Python object (a list of file paths) decoded from the response frame
         matching_files = response
 
         return matching_files
 
+    async def stream_search_query(self, search_input, chunk_size=None):
+        """
+        Send a search query in a query_stream message and iterate over its result as the server produces it.
+
+        Neither side holds the whole result: the server resolves and sends one chunk at a time, and stops
+        while this iterator is a few chunks behind.
+
+        Args:
+            search_input (dict): The search query parameters, as for send_search_query.
+            chunk_size (int, optional): Maximum number of entries per chunk, at most the server's chunk size.
+
+        Yields:
+            list: The next chunk of matching file paths, or of [file path, row group ids] pairs with
+                "row_groups".
+
+        Example:
+            async for matching_files in client.stream_search_query({'store': 'sales', 'query': query}):
+                for file_path in matching_files:
+                    print(file_path)
+        """
+        if chunk_size is not None:
+            search_input = dict(search_input, chunk_size=chunk_size)
+        message = self.build_message("query_stream", search_input)
+        async for chunk in self.stream_message(message):
+            yield chunk
+
+    def build_message(self, message_type, payload):
+        """Build a message of the given type with payload encoded in the payload format of the client"""
+        if self.payload_format == BINARY_FORMAT:
+            return TCPMessage(message_type, BINARY_FORMAT, codec.encode(payload))
+        return TCPMessage(message_type, "json", json.dumps(payload))
+
+    async def send_query_batch(self, entries):
+        """
+        Send several queries in a single query_batch message and receive their results, in order.
+
+        Args:
+            entries (list): {"store", "query"} dictionaries, with an optional "row_groups" flag.
+
+        Returns:
+            list: The result of every entry, as returned by send_search_query.
+        """
+        message = self.build_message("query_batch", {'queries': entries})
+        return await self.send_message(message)
+
+    async def send_kv_mget(self, keys):
+        """
+        Get several keys of the server's key-value store in a single kv_mget message.
+
+        Returns:
+            dict: {"response": {key: value}, "missing": [keys that are not set or expired]}.
+        """
+        message = self.build_message("kv_mget", {'keys': list(keys)})
+        return await self.send_message(message)
+
+    async def send_kv_mset(self, items, ttl=None, durable=False):
+        """
+        Set several keys in a single kv_mset message.
+
+        Args:
+            items (dict): {key: value} to set.
+            ttl (float or dict, optional): Time to live in seconds of every key, or {key: ttl}. Default is the
+                server's default TTL.
+            durable (bool, optional): Wait until the values are committed to disk. Default is False.
+        """
+        ttls = ttl if isinstance(ttl, dict) else {}
+        payload = {'items': [{'key': key, 'value': value, 'ttl': ttls.get(key, None if ttls else ttl)}
+                             for key, value in items.items()],
+                   'durable': durable}
+        message = self.build_message("kv_mset", payload)
+        return await self.send_message(message)
+
+    async def send_kv_mdelete(self, keys, durable=False):
+        """
+        Delete several keys in a single kv_mdelete message.
+
+        Returns:
+            dict: {"response": {key: "deleted" or "not found"}}.
+        """
+        message = self.build_message("kv_mdelete", {'keys': list(keys), 'durable': durable})
+        return await self.send_message(message)
+
     async def send_message(self, message):
         """
         Send a TCPMessage to the Petals server and receive the server's response.
 
-        This method establishes a TCP connection to the Petals server, sends the message in XML format,
-        and waits for the server to respond. It retries the connection if necessary.
+        This method sends the message as a frame on a pooled connection, opening one if needed, and waits
+        for the server to respond. It retries on a new connection if necessary.
 
         Args:
             message (TCPMessage): The TCPMessage object to be sent to the Petals server.
@@ -158,40 +410,56 @@ class PetalsClient:
             message = TCPMessage("message", "text", "Hello server!")
             asyncio.run(client.send_message(message))
         """
-        xml_string = message.to_xml()
         for attempt in range(self.retries):
+            connection = None
             try:
-                reader, writer = await asyncio.wait_for(
-                    asyncio.open_connection(self.host, self.port),
-                    timeout=self.timeout)
-
-                writer.write(xml_string.encode())
-                await writer.drain()
-
-                buffer = ""
-                while True:
-                    chunk = await asyncio.wait_for(
-                        reader.read(1024),
-                        timeout=self.timeout)
-
-                    if not chunk:
-                        break
-                    buffer += chunk.decode()
-                    if buffer.endswith(f"</{message.cls}>"):
-                        break
-
-                response_string = buffer.replace(f"<{message.cls}>", "").replace(f"</{message.cls}>", "").strip()
-                response = self.parse_response(message.format, response_string)
+                connection = await self._get_connection()
+                request_id = next(self._request_ids) & 0xFFFFFFFF
+                future = connection.send(request_id, message)
+                return await asyncio.wait_for(connection.response(request_id, future), timeout=self.timeout)
+
+            except (asyncio.TimeoutError, ConnectionError) as e:
+                if connection is not None:
+                    # The connection may be dead or out of sync, requests pipelined on it are retried too
+                    connection.close()
+                logging.warning(f"Attempt {attempt + 1} failed ({type(e).__name__}). Retrying.")
+                await asyncio.sleep(2 ** attempt)
 
-                print(f"Received from server: {response}")
+        raise Exception("Server is not responding.")
 
-                writer.close()
-                await writer.wait_closed()
+    async def stream_message(self, message):
+        """
+        Send a TCPMessage answered by a streamed response and yield the payload of every chunk.
 
-                return response
+        Like send_message, it retries on a new connection, but only until the first chunk was received: a
+        stream interrupted after that raises ConnectionResetError. timeout bounds the wait for each chunk.
 
-            except (asyncio.TimeoutError, ConnectionRefusedError) as e:
-                print(f"Attempt {attempt + 1} failed. Retrying.")
+        Raises:
+            RuntimeError: If the server failed to produce the stream.
+        """
+        for attempt in range(self.retries):
+            connection = None
+            received = False
+            try:
+                connection = await self._get_connection()
+                request_id = next(self._request_ids) & 0xFFFFFFFF
+                queue = connection.send_stream(request_id, message)
+                try:
+                    while True:
+                        chunk = await connection.next_chunk(queue, self.timeout)
+                        if chunk is None:
+                            return
+                        received = True
+                        yield chunk
+                finally:
+                    connection.end_stream(request_id)
+
+            except (asyncio.TimeoutError, ConnectionError) as e:
+                if connection is not None:
+                    connection.close()
+                if received:
+                    raise ConnectionResetError(f"Stream interrupted ({type(e).__name__})") from e
+                logging.warning(f"Attempt {attempt + 1} failed ({type(e).__name__}). Retrying.")
                 await asyncio.sleep(2 ** attempt)
 
         raise Exception("Server is not responding.")
@@ -201,14 +469,14 @@ class PetalsClient:
         Parse the server's response based on the specified format.
 
         Args:
-            format (str): The format of the server's response ('text', 'json', or 'base64').
-            response_string (str): The server's response string.
+            format (str): The format of the server's response ('text', 'json', 'base64' or 'binary').
+            response_string (str): The server's response string, base64 encoded for 'binary'.
 
         Returns:
             any: The parsed server response based on the specified format.
 
         Raises:
-            ValueError: If the specified format is not one of 'text', 'json', or 'base64'.
+            ValueError: If the specified format is not one of 'text', 'json', 'base64' or 'binary'.
 
         Example:
             # Parse a JSON response
@@ -222,6 +490,8 @@ class PetalsClient:
             return json.loads(response_string)
         elif format == "base64":
             return base64.b64decode(response_string).decode()
+        elif format == BINARY_FORMAT:
+            return codec.decode(base64.b64decode(response_string))
         else:
             raise ValueError(f"Unexpected response format: {format}")
 
@@ -0,0 +1,224 @@
+"""
+Compact binary encoding of message payloads, the "binary" message format.
+
+The encoding is msgpack: nil, booleans, integers, floats, strings, bytes, arrays and maps use the msgpack
+wire format, so any msgpack library can read them. Lists of strings, such as the file names of a query
+result, use a msgpack extension instead: the strings joined by NUL bytes, encoded and split in one call
+each rather than one per string.
+
+The codec is pure Python: it beats JSON on large file name lists, but arbitrary nested structures encode and
+decode slower than with the C JSON module (see benchmarks/payload_formats.py).
+"""
+import struct
+
+STRING_LIST_EXT = 1  # msgpack extension type of a NUL separated list of strings
+
+_UINT8, _UINT16, _UINT32, _UINT64 = (struct.Struct(f'>{code}') for code in 'BHIQ')
+_INT8, _INT16, _INT32, _INT64 = (struct.Struct(f'>{code}') for code in 'bhiq')
+_FLOAT32, _FLOAT64 = struct.Struct('>f'), struct.Struct('>d')
+
+# Single byte encodings: positive and negative fixints, fixstr, fixarray and fixmap headers
+_FIXINT = {value: bytes((value & 0xFF,)) for value in range(-32, 128)}
+_FIXSTR = [bytes((0xA0 | length,)) for length in range(32)]
+_FIXARRAY = [bytes((0x90 | length,)) for length in range(16)]
+_FIXMAP = [bytes((0x80 | length,)) for length in range(16)]
+
+
+def encode(obj):
+    """Encodes dicts, lists, tuples, strings, bytes, ints, floats, booleans and None"""
+    parts = []
+    _encode(obj, parts, parts.append)
+    return b''.join(parts)
+
+
+def _header(length, fixed, tag8, tag16, tag32):
+    if fixed is not None and length < len(fixed):
+        return fixed[length]
+    if tag8 is not None and length < 0x100:
+        return bytes((tag8, length))
+    if length < 0x10000:
+        return bytes((tag16,)) + _UINT16.pack(length)
+    return bytes((tag32,)) + _UINT32.pack(length)
+
+
+def _encode_int(value):
+    if value >= 0:
+        for tag, packer in ((0xCC, _UINT8), (0xCD, _UINT16), (0xCE, _UINT32), (0xCF, _UINT64)):
+            if value < 1 << (8 * packer.size):
+                return bytes((tag,)) + packer.pack(value)
+    else:
+        for tag, packer in ((0xD0, _INT8), (0xD1, _INT16), (0xD2, _INT32), (0xD3, _INT64)):
+            if value >= -(1 << (8 * packer.size - 1)):
+                return bytes((tag,)) + packer.pack(value)
+    raise OverflowError(f'{value} does not fit in 64 bits')
+
+
+def _encode_string_list(strings, append):
+    """Encodes a list of strings as a STRING_LIST_EXT extension, returns False if one contains NUL"""
+    joined = '\0'.join(strings)
+    if joined.count('\0') != len(strings) - 1:
+        return False
+    data = joined.encode()
+    append(_header(len(data), None, 0xC7, 0xC8, 0xC9) + bytes((STRING_LIST_EXT,)))
+    append(data)
+    return True
+
+
+def _encode(obj, parts, append):
+    kind = type(obj)
+    if kind is str:
+        data = obj.encode()
+        length = len(data)
+        append(_FIXSTR[length] if length < 32 else _header(length, None, 0xD9, 0xDA, 0xDB))
+        append(data)
+    elif kind is int:
+        append(_FIXINT.get(obj) or _encode_int(obj))
+    elif kind is list or kind is tuple:
+        if obj and all(type(item) is str for item in obj) and _encode_string_list(obj, append):
+            return
+        length = len(obj)
+        append(_FIXARRAY[length] if length < 16 else _header(length, None, None, 0xDC, 0xDD))
+        for item in obj:
+            _encode(item, parts, append)
+    elif kind is dict:
+        length = len(obj)
+        append(_FIXMAP[length] if length < 16 else _header(length, None, None, 0xDE, 0xDF))
+        for key, value in obj.items():
+            _encode(key, parts, append)
+            _encode(value, parts, append)
+    elif obj is None:
+        append(b'\xc0')
+    elif obj is True:
+        append(b'\xc3')
+    elif obj is False:
+        append(b'\xc2')
+    elif kind is float:
+        append(b'\xcb' + _FLOAT64.pack(obj))
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        data = bytes(obj)
+        append(_header(len(data), None, 0xC4, 0xC5, 0xC6))
+        append(data)
+    # Subclasses, such as enums or named tuples
+    elif isinstance(obj, str):
+        _encode(str(obj), parts, append)
+    elif isinstance(obj, int):
+        _encode(int(obj), parts, append)
+    elif isinstance(obj, float):
+        _encode(float(obj), parts, append)
+    elif isinstance(obj, (list, tuple)):
+        _encode(list(obj), parts, append)
+    elif isinstance(obj, dict):
+        _encode(dict(obj), parts, append)
+    elif hasattr(obj, 'item'):
+        # NumPy scalars
+        _encode(obj.item(), parts, append)
+    else:
+        raise TypeError(f'Cannot encode {type(obj).__name__}')
+
+
+def decode(data):
+    """Decodes a payload written by encode (or by msgpack without extensions)"""
+    data = memoryview(data)
+    obj, offset = _decode(data, 0)
+    if offset != len(data):
+        raise ValueError(f'{len(data) - offset} trailing bytes after the payload')
+    return obj
+
+
+def _decode(data, offset):
+    return _DECODERS[data[offset]](data, offset + 1)
+
+
+def _string(data, offset, length):
+    end = offset + length
+    return str(data[offset:end], 'utf-8'), end
+
+
+def _array(data, offset, length):
+    items = []
+    append = items.append
+    for _ in range(length):
+        tag = data[offset]
+        if tag < 0x80:
+            # Inline the common positive fixint
+            append(tag)
+            offset += 1
+        else:
+            item, offset = _DECODERS[tag](data, offset + 1)
+            append(item)
+    return items, offset
+
+
+def _map(data, offset, length):
+    result = {}
+    for _ in range(length):
+        key, offset = _DECODERS[data[offset]](data, offset + 1)
+        result[key], offset = _DECODERS[data[offset]](data, offset + 1)
+    return result, offset
+
+
+def _binary(data, offset, length):
+    return bytes(data[offset:offset + length]), offset + length
+
+
+def _extension(data, offset, length):
+    ext_type = data[offset]
+    start = offset + 1
+    end = start + length
+    if ext_type != STRING_LIST_EXT:
+        raise ValueError(f'Unknown extension type {ext_type}')
+    return str(data[start:end], 'utf-8').split('\0'), end
+
+
+def _fixed(decoder, length):
+    return lambda data, offset: decoder(data, offset, length)
+
+
+def _sized(decoder, packer):
+    def decode_sized(data, offset):
+        (length,) = packer.unpack_from(data, offset)
+        return decoder(data, offset + packer.size, length)
+
+    return decode_sized
+
+
+def _value(packer):
+    return lambda data, offset: (packer.unpack_from(data, offset)[0], offset + packer.size)
+
+
+def _constant(value):
+    return lambda data, offset: (value, offset)
+
+
+def _unsupported(tag):
+    def decode_unsupported(data, offset):
+        raise ValueError(f'Unsupported tag 0x{tag:02x}')
+
+    return decode_unsupported
+
+
+# Decoder of every first byte, called with the offset following it and returning (value, next offset)
+_DECODERS = [_unsupported(tag) for tag in range(256)]
+for _tag in range(0x80):
+    _DECODERS[_tag] = _constant(_tag)
+for _tag in range(0xE0, 0x100):
+    _DECODERS[_tag] = _constant(_tag - 0x100)
+for _length in range(16):
+    _DECODERS[0x80 | _length] = _fixed(_map, _length)
+    _DECODERS[0x90 | _length] = _fixed(_array, _length)
+for _length in range(32):
+    _DECODERS[0xA0 | _length] = _fixed(_string, _length)
+_DECODERS[0xC0] = _constant(None)
+_DECODERS[0xC2] = _constant(False)
+_DECODERS[0xC3] = _constant(True)
+for _tag, _decoder, _packer in (
+        (0xC4, _binary, _UINT8), (0xC5, _binary, _UINT16), (0xC6, _binary, _UINT32),
+        (0xC7, _extension, _UINT8), (0xC8, _extension, _UINT16), (0xC9, _extension, _UINT32),
+        (0xD9, _string, _UINT8), (0xDA, _string, _UINT16), (0xDB, _string, _UINT32),
+        (0xDC, _array, _UINT16), (0xDD, _array, _UINT32),
+        (0xDE, _map, _UINT16), (0xDF, _map, _UINT32)):
+    _DECODERS[_tag] = _sized(_decoder, _packer)
+for _tag, _packer in ((0xCA, _FLOAT32), (0xCB, _FLOAT64),
+                      (0xCC, _UINT8), (0xCD, _UINT16), (0xCE, _UINT32), (0xCF, _UINT64),
+                      (0xD0, _INT8), (0xD1, _INT16), (0xD2, _INT32), (0xD3, _INT64)):
+    _DECODERS[_tag] = _value(_packer)
@@ -0,0 +1,79 @@
+import threading
+from collections import OrderedDict
+
+
+class FilterCache:
+    """
+    Size-aware LRU cache for lazily loaded filters.
+
+    Entries are weighed by their size in bytes (``Filter.nbytes()``) rather than by count, and the least
+    recently used entries are evicted once the total exceeds ``max_bytes``.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (filter, size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, loader):
+        """Returns the cached filter for key, calling loader(key) and caching the result on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        filter = loader(key)
+        self.put(key, filter)
+        return filter
+
+    def put(self, key, filter):
+        size = filter.nbytes()
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+
+            # A filter larger than the whole budget is handed back to the caller but never kept
+            if size > self.max_bytes:
+                return
+
+            self._entries[key] = (filter, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, predicate=None):
+        """Drops every entry, or only those whose key matches predicate"""
+        with self._lock:
+            if predicate is None:
+                self._entries.clear()
+                self.current_bytes = 0
+                return
+            for key in [key for key in self._entries if predicate(key)]:
+                _, size = self._entries.pop(key)
+                self.current_bytes -= size
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -1,5 +1,9 @@
+import itertools
+import json
+import pickle
+import sys
 from abc import abstractmethod, ABC
-from datetime import datetime
+from datetime import date, datetime
 import jellyfish
 from bitarray import bitarray
 from intervaltree import IntervalTree
@@ -8,6 +12,37 @@ from pybloom_live import BloomFilter as bf
 import pandas as pd
 
 
+# Operators of a leaf rule: {"field": ..., "operator": ..., "value": ...}, "=" when omitted
+OPERATORS = ('=', '!=', '<', '<=', '>', '>=', 'between', 'in')
+
+
+def _to_builtin(value):
+    """Converts numpy scalars to their python equivalent so they can be JSON encoded"""
+    return value.item() if hasattr(value, 'item') else value
+
+
+def _bounds_match(lower, upper, operator, value):
+    """Whether a column whose values lie within [lower, upper] may hold a value satisfying operator and value"""
+    if operator == '=':
+        return lower <= value <= upper
+    if operator == '!=':
+        return not lower == upper == value
+    if operator == '<':
+        return lower < value
+    if operator == '<=':
+        return lower <= value
+    if operator == '>':
+        return upper > value
+    if operator == '>=':
+        return upper >= value
+    if operator == 'between':
+        low, high = value
+        return lower <= high and low <= upper
+    if operator == 'in':
+        return any(lower <= item <= upper for item in value)
+    raise ValueError(f"Unknown operator '{operator}'")
+
+
 class Filter(ABC):
     name = None
 
@@ -15,6 +50,97 @@ class Filter(ABC):
     def test(self, value):
         pass
 
+    def test_operator(self, operator, value):
+        """
+        Tests a leaf rule, False only if no value of the column can satisfy it.
+
+        Operators a filter cannot answer always pass, so the file is kept.
+        """
+        if operator == '=':
+            return self.test(value)
+        if operator == 'in':
+            return self.test_any(value)
+        if operator not in OPERATORS:
+            raise ValueError(f"Unknown operator '{operator}'")
+        return True
+
+    def test_any(self, values):
+        """Whether any of values may be in the column"""
+        return any(self.test(value) for value in values)
+
+    @classmethod
+    def builder(cls, **params):
+        """Returns a builder fed chunk by chunk with add(chunk), build() returns the filter"""
+        return ChunkBuilder(cls, params)
+
+    def nbytes(self):
+        """
+        Approximate in-memory size of the filter, used to weigh it in the filter cache.
+
+        The default pickles the filter, subclasses override it with an estimate that does not walk their data.
+        """
+        return len(pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def to_segment(self):
+        """Returns the (JSON metadata, raw payload) pair stored for this filter in a segment file"""
+        return {}, pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def from_segment(cls, meta, payload):
+        """Rebuilds a filter from a segment entry, payload is a memoryview over the mapped file"""
+        return pickle.loads(payload)
+
+
+class ChunkBuilder:
+    """
+    Builds a filter from chunks pushed one at a time, by replaying them into Filter.create.
+
+    Every chunk is held until build, the whole column of the file: filters that can fold chunks in one at a
+    time use UpdateBuilder instead.
+    """
+
+    def __init__(self, filter_class, params):
+        self.filter_class = filter_class
+        self.params = params
+        self.chunks = []
+
+    def add(self, chunk):
+        self.chunks.append(chunk)
+
+    def build(self):
+        return self.filter_class.create(reader=iter(self.chunks), **self.params)
+
+
+class UpdateBuilder(ChunkBuilder):
+    """Creates the filter from the first chunk and folds the following ones in with Filter.update"""
+
+    def __init__(self, filter_class, params):
+        super().__init__(filter_class, params)
+        self.filter = None
+
+    def add(self, chunk):
+        if self.filter is None:
+            self.filter = self.filter_class.create(reader=iter([chunk]), **self.params)
+        else:
+            self.filter.update(chunk)
+
+    def build(self):
+        return self.filter if self.filter is not None else super().build()
+
+
+class BloomBuilder(ChunkBuilder):
+    """Collects the unique values of the chunks, the bloom filter is sized once they are all known"""
+
+    def __init__(self, filter_class, params):
+        super().__init__(filter_class, params)
+        self.values = set()
+
+    def add(self, chunk):
+        self.values.update(self.filter_class.get_valid_data(chunk.squeeze(), self.params.get('data_type', 'str')))
+
+    def build(self):
+        return self.filter_class.from_values(self.values, **self.params)
+
 
 class BloomFilter(Filter):
     name = 'bloom'
@@ -30,19 +156,30 @@ class BloomFilter(Filter):
         return valid_data
 
     @classmethod
-    def create(cls, reader=None, error_rate=0.1, data_type='str'):
-        # First, calculate total length based on unique values from all chunks
+    def unique_values(cls, reader, data_type='str'):
+        """Collects the unique valid values from all chunks"""
         unique_data = set()
         for chunk in reader:
             unique_data.update(cls.get_valid_data(chunk.squeeze(), data_type))
+        return unique_data
+
+    @classmethod
+    def create(cls, reader=None, error_rate=0.1, data_type='str'):
+        return cls.from_values(cls.unique_values(reader, data_type), error_rate, data_type)
 
+    @classmethod
+    def builder(cls, **params):
+        return BloomBuilder(cls, params)
+
+    @classmethod
+    def from_values(cls, unique_data, error_rate=0.1, data_type='str'):
         total_length = len(unique_data)
 
-        # Instantiate a bloom filter with the calculated total length
-        bloom = bf(capacity=total_length, error_rate=error_rate)
+        # Instantiate a bloom filter with the calculated total length, a column chunk may only hold nulls
+        bloom = bf(capacity=max(total_length, 1), error_rate=error_rate)
 
-        # Now, add all unique values to the bloom filter
-        for item in unique_data:
+        # Now, add all unique values to the bloom filter, in a stable order so the output is reproducible
+        for item in sorted(unique_data):
             bloom.add(item)
 
         data = {'filter': bloom, 'data_type': data_type}
@@ -55,6 +192,28 @@ class BloomFilter(Filter):
     def test(self, value):
         return value in self.filter
 
+    def test_any(self, values):
+        bloom = self.filter
+        return any(value in bloom for value in values)
+
+    def nbytes(self):
+        return self.filter.bitarray.nbytes
+
+    def to_segment(self):
+        bloom = self.filter
+        meta = {'error_rate': bloom.error_rate, 'num_slices': bloom.num_slices,
+                'bits_per_slice': bloom.bits_per_slice, 'capacity': bloom.capacity, 'count': bloom.count,
+                'data_type': self.data_type}
+        return meta, bloom.bitarray.tobytes()
+
+    @classmethod
+    def from_segment(cls, meta, payload):
+        # Rebuild the pybloom_live filter around the mapped bits instead of copying them
+        bloom = bf.__new__(bf)
+        bloom._setup(meta['error_rate'], meta['num_slices'], meta['bits_per_slice'], meta['capacity'], meta['count'])
+        bloom.bitarray = bitarray(buffer=payload, endian='little')
+        return cls({'filter': bloom, 'data_type': meta['data_type']})
+
 
 class RangeFilter(Filter):
     name = 'range'
@@ -65,13 +224,20 @@ class RangeFilter(Filter):
 
     @classmethod
     def create(cls, reader=None):
-        # Calculate global min and max from all chunks
-        min_val = min(chunk.min() for chunk in reader)
-        max_val = max(chunk.max() for chunk in reader)
+        # Calculate global min and max from all chunks, in a single pass over the reader
+        min_val = max_val = None
+        for chunk in reader:
+            chunk_min, chunk_max = chunk.min(), chunk.max()
+            min_val = chunk_min if min_val is None else min(min_val, chunk_min)
+            max_val = chunk_max if max_val is None else max(max_val, chunk_max)
 
         data = {'min': min_val, 'max': max_val}
         return cls(data)
 
+    @classmethod
+    def builder(cls, **params):
+        return UpdateBuilder(cls, params)
+
     def update(self, chunk):
         min_val = chunk.min()
         max_val = chunk.max()
@@ -81,9 +247,23 @@ class RangeFilter(Filter):
     def test(self, value):
         return self.min <= value <= self.max
 
+    def test_operator(self, operator, value):
+        return _bounds_match(self.min, self.max, operator, value)
+
+    def nbytes(self):
+        return sys.getsizeof(self.min) + sys.getsizeof(self.max)
+
+    def to_segment(self):
+        return {'min': _to_builtin(self.min), 'max': _to_builtin(self.max)}, b''
+
+    @classmethod
+    def from_segment(cls, meta, payload):
+        return cls(meta)
+
 
 class SetMembershipFilter(Filter):
     name = 'set_membership'
+    NBYTES_SAMPLE = 64  # values whose size is measured to estimate the size of the set
 
     def __init__(self, data):
         self.allowed_values = set(data['allowed_values'])
@@ -95,12 +275,44 @@ class SetMembershipFilter(Filter):
         data = {'allowed_values': allowed_values}
         return cls(data)
 
+    @classmethod
+    def builder(cls, **params):
+        return UpdateBuilder(cls, params)
+
     def update(self, chunk):
         self.allowed_values.update(chunk.unique())
 
     def test(self, value):
         return value in self.allowed_values
 
+    def test_operator(self, operator, value):
+        if operator == '!=':
+            return bool(self.allowed_values - {value})
+        return super().test_operator(operator, value)
+
+    def test_any(self, values):
+        return not self.allowed_values.isdisjoint(values)
+
+    def nbytes(self):
+        values = self.allowed_values
+        sample = list(itertools.islice(values, self.NBYTES_SAMPLE))
+        value_size = sum(map(sys.getsizeof, sample)) / len(sample) if sample else 0
+        return sys.getsizeof(values) + int(value_size * len(values))
+
+    def to_segment(self):
+        try:
+            payload = json.dumps(sorted(_to_builtin(value) for value in self.allowed_values))
+        except TypeError:
+            # Mixed or non JSON types, keep the generic encoding
+            return super().to_segment()
+        return {'encoding': 'json'}, payload.encode()
+
+    @classmethod
+    def from_segment(cls, meta, payload):
+        if meta.get('encoding') != 'json':
+            return super().from_segment(meta, payload)
+        return cls({'allowed_values': json.loads(bytes(payload))})
+
 
 class FuzzyStringFilter(SetMembershipFilter):
     name = 'fuzzy_string'
@@ -119,6 +331,10 @@ class FuzzyStringFilter(SetMembershipFilter):
                 return True
         return False
 
+    # Similar values match too, exact set operations do not apply
+    test_operator = Filter.test_operator
+    test_any = Filter.test_any
+
 
 class DateFilter(Filter):
     name = 'date'
@@ -128,40 +344,88 @@ class DateFilter(Filter):
         # Determine min and max dates from all chunks
         min_date = max_date = None
         for chunk in reader:
-            # Drop missing values and check if the remaining values are already date objects
-            non_null_chunk = chunk.dropna()
-            if not non_null_chunk.empty and isinstance(non_null_chunk.iloc[0], datetime.date):
-                dates = non_null_chunk
-            else:
-                dates = pd.to_datetime(non_null_chunk).dt.date
-            if not dates.empty:
+            bounds = cls._chunk_bounds(chunk)
+            if bounds is not None:
                 if min_date is None:
-                    min_date = dates.min()
-                    max_date = dates.max()
+                    min_date, max_date = bounds
                 else:
-                    min_date = min(min_date, dates.min())
-                    max_date = max(max_date, dates.max())
+                    min_date = min(min_date, bounds[0])
+                    max_date = max(max_date, bounds[1])
 
-        data = {'min': min_date.strftime(date_format), 'max': max_date.strftime(date_format),
-                'date_format': date_format}
+        if min_date is None:
+            # Only missing values, as in a row group of nulls: nothing matches
+            data = {'min': None, 'max': None, 'date_format': date_format}
+        else:
+            data = {'min': min_date.strftime(date_format), 'max': max_date.strftime(date_format),
+                    'date_format': date_format}
         return cls(data)
 
+    @classmethod
+    def builder(cls, **params):
+        return UpdateBuilder(cls, params)
+
+    @staticmethod
+    def _chunk_bounds(chunk):
+        """Returns the (min, max) dates of a chunk, None if it only holds missing values"""
+        # Drop missing values and check if the remaining values are already date objects
+        non_null_chunk = chunk.dropna()
+        if non_null_chunk.empty:
+            return None
+        if isinstance(non_null_chunk.iloc[0], date):
+            dates = non_null_chunk
+        else:
+            dates = pd.to_datetime(non_null_chunk).dt.date
+        return tuple(value.date() if isinstance(value, datetime) else value for value in (dates.min(), dates.max()))
+
     def __init__(self, data):
         self.date_format = data['date_format']
-        self.min = self._to_date(data['min'])
-        self.max = self._to_date(data['max'])
+        self.min = None if data['min'] is None else self._to_date(data['min'], self.date_format)
+        self.max = None if data['max'] is None else self._to_date(data['max'], self.date_format)
+
+    def update(self, chunk):
+        bounds = self._chunk_bounds(chunk)
+        if bounds is None:
+            return
+        # Bounds go through date_format like the ones given to create
+        min_date, max_date = (self._to_date(bound.strftime(self.date_format), self.date_format) for bound in bounds)
+        self.min = min_date if self.min is None else min(self.min, min_date)
+        self.max = max_date if self.max is None else max(self.max, max_date)
 
     def test(self, value):
+        if self.min is None:
+            return False
         value_date = self._to_date(value, self.date_format)
         return self.min <= value_date <= self.max
 
+    def test_operator(self, operator, value):
+        if self.min is None:
+            return False
+        if operator in ('between', 'in'):
+            value = [self._to_date(item, self.date_format) for item in value]
+        else:
+            value = self._to_date(value, self.date_format)
+        return _bounds_match(self.min, self.max, operator, value)
+
+    def nbytes(self):
+        return sys.getsizeof(self.min) + sys.getsizeof(self.max) + sys.getsizeof(self.date_format)
+
+    def to_segment(self):
+        if self.min is None:
+            return {'min': None, 'max': None, 'date_format': self.date_format}, b''
+        return {'min': self.min.strftime(self.date_format), 'max': self.max.strftime(self.date_format),
+                'date_format': self.date_format}, b''
+
+    @classmethod
+    def from_segment(cls, meta, payload):
+        return cls(meta)
+
     @staticmethod
     def _to_date(value, date_format):
         if isinstance(value, (str)):
             return datetime.strptime(value, date_format).date()
-        elif isinstance(value, (datetime.datetime, pd.Timestamp)):
+        elif isinstance(value, (datetime, pd.Timestamp)):
             return value.date()
-        elif isinstance(value, datetime.date):
+        elif isinstance(value, date):
             return value
         else:
             raise TypeError("Unsupported date type")
@@ -169,6 +433,7 @@ class DateFilter(Filter):
 
 class IntervalTreeFilter(Filter):
     name = 'intervaltree'
+    INTERVAL_NBYTES = 480  # memory held by one interval and its tree node
 
     def __init__(self, data):
         self.tree = IntervalTree()
@@ -185,6 +450,30 @@ class IntervalTreeFilter(Filter):
     def test(self, point):
         return bool(self.tree[point])
 
+    def test_operator(self, operator, value):
+        # Intervals are half-open, [begin, end)
+        if operator == '=':
+            return self.test(value)
+        if operator == 'in':
+            return self.test_any(value)
+        if operator not in OPERATORS:
+            raise ValueError(f"Unknown operator '{operator}'")
+        if not self.tree:
+            return False
+        if operator == '!=':
+            return True
+        if operator == '<':
+            return self.tree.begin() < value
+        if operator == '<=':
+            return self.tree.begin() <= value
+        if operator in ('>', '>='):
+            return self.tree.end() > value
+        low, high = value  # between
+        return self.tree.overlaps(low, high) or self.tree.overlaps_point(high)
+
+    def nbytes(self):
+        return len(self.tree) * self.INTERVAL_NBYTES
+
 
 class KDTreeFilter(Filter):
     name = 'kdtree'
@@ -205,6 +494,10 @@ class KDTreeFilter(Filter):
         distance, _ = self.tree.query([point])
         return distance <= self.radius
 
+    def nbytes(self):
+        # The points and their permutation, the nodes are small next to them
+        return self.tree.data.nbytes + self.tree.indices.nbytes
+
 
 class BitVectorFilter(Filter):
     name = 'bitvector'
@@ -224,3 +517,6 @@ class BitVectorFilter(Filter):
 
     def test(self, bit):
         return self.vector[bit]
+
+    def nbytes(self):
+        return self.vector.nbytes
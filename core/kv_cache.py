@@ -0,0 +1,80 @@
+import sys
+import threading
+from collections import OrderedDict
+
+from core.ttl_dict import now_ms
+
+
+class KVCache:
+    """
+    In-memory LRU tier of hot TTLDictionary entries.
+
+    Entries are weighed by the approximate size of their key and value, and the least recently used ones
+    are evicted once the total exceeds ``max_bytes``. Every entry keeps the expiry of the stored one, an
+    expired entry is a miss.
+    """
+
+    ENTRY_OVERHEAD = 100  # bytes of bookkeeping per entry
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (value, expires_at, size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the (value, expires_at) of key, None if it is not cached or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= now_ms():
+                if entry is not None:
+                    del self._entries[key]
+                    self.current_bytes -= entry[2]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, key, value, expires_at):
+        size = sys.getsizeof(key) + sys.getsizeof(value) + self.ENTRY_OVERHEAD
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[2]
+            if size > self.max_bytes:
+                return
+
+            self._entries[key] = (value, expires_at, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.current_bytes -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -1,13 +1,24 @@
+import copy
+import hashlib
+import itertools
 import json
 import os
 import pickle
+import shutil
 from abc import abstractmethod, ABC
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 from pathlib import Path
 from pyarrow import parquet as pq
 import pandas as pd
 
+from core.bloom_index import BLOOM_INDEX_SUFFIX, BitSlicedBloomIndex
+from core.filters import BloomFilter, DateFilter, RangeFilter
+from core.segment import SEGMENT_SUFFIX, SegmentReader, SegmentWriter
 from core.utils import get_filter_classes
 
+MANIFEST_SUFFIX = '.manifest.json'
+
 
 class FilterSelector:
     def __init__(self, all_chunks, column):
@@ -55,66 +66,416 @@ class AbstractFilterGenerator(ABC):
     DEFAULT_CHUNK_SIZE = 10000
     BLOOM_THRESHOLD = 10000
     SET_THRESHOLD = 1000
+    SAMPLE_SIZE = 100000  # rows used to select the filter strategy of a column
+    FILTER_FORMATS = ('segment', 'pickle')
+    SUPPORTS_ROW_GROUPS = False
+
+    def __init__(self, data_dir, store_name, filter_dir, config_file=None, included_columns=None,
+                 filter_format='segment', bit_sliced_bloom=False, workers=1, row_group_filters=False):
+        if filter_format not in self.FILTER_FORMATS:
+            raise ValueError(f"Invalid filter format '{filter_format}'")
+        if row_group_filters and not self.SUPPORTS_ROW_GROUPS:
+            raise ValueError(f"{type(self).__name__} cannot build row group filters")
+        if row_group_filters and filter_format != 'segment':
+            raise ValueError("Row group filters are only stored in the segment format")
 
-    def __init__(self, data_dir, store_name, filter_dir, config_file=None, included_columns=None):
         self.data_dir = data_dir
         self.store_name = store_name
         self.filter_dir = filter_dir
         self.filter_classes = get_filter_classes()
         self.config = {}
         self.included_columns = set(included_columns or [])
+        self.filter_format = filter_format
+        self.bit_sliced_bloom = bit_sliced_bloom
+        self.workers = workers
+        self.row_group_filters = row_group_filters
 
         # If a configuration file is provided, load it into the config dictionary
         if config_file is not None:
             with open(config_file, 'r') as f:
                 self.config = json.load(f)
 
-    def generate_filters(self):
-        metadata = {}  # Store metadata about the filters
-
-        for root, _, files in os.walk(self.data_dir):
-            for file in self.get_files(root):
-                path = Path(root) / file
-
-                # Load data
-                reader_for_whole_df = self.load_data(path, chunksize=10)
-                df = next(reader_for_whole_df)
+    def generate_filters(self, force=False):
+        """
+        Generates the filters of every data file of the store.
+
+        A manifest of the data files (size, mtime, content hash, row groups) is kept next to the store
+        metadata. Files that did not change since the last run are skipped, files that only gained row
+        groups have their filters extended with Filter.update, the others are rebuilt. force=True
+        ignores the manifest and rebuilds everything, as does a change of the settings the filters
+        depend on (config, included columns, filter format, row group filters).
+        """
+        settings = self.settings_fingerprint()
+        previous_settings, previous = self.read_manifest()
+        if force:
+            previous = {}
+        elif previous_settings != settings:
+            # Filters of other settings may be in another format or of dropped columns, none of them is kept
+            for key in previous:
+                self.remove_file_filters(Path(key).stem)
+            previous = {}
+
+        paths = [Path(root) / file for root, _, _ in os.walk(self.data_dir) for file in self.get_files(root)]
+        keys = [self.manifest_key(path) for path in paths]
+        previous_entries = [previous.get(key) for key in keys]
+        if self.workers > 1:
+            # Files are independent, each worker writes the filters of the files it is handed
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                results = list(executor.map(self.update_file_filters, paths, previous_entries))
+        else:
+            results = list(map(self.update_file_filters, paths, previous_entries))
 
-                # Skip if data is empty
-                if df.empty:
-                    continue
+        # Merge in file order so the output does not depend on the number of workers
+        manifest = {}
+        metadata = {}  # Store metadata about the filters
+        bloom_values = {}  # column -> {file: unique values}, only filled for bit-sliced bloom indexes
+        changed = False
+        for key, previous_entry, (entry, file_bloom_values) in zip(keys, previous_entries, results):
+            manifest[key] = entry
+            metadata.update(entry['filters'])
+            changed = changed or previous_entry is None or entry['hash'] != previous_entry['hash']
+            for column, values in file_bloom_values.items():
+                bloom_values.setdefault(column, {})[Path(key).stem] = values
+
+        for key in previous.keys() - manifest.keys():
+            # The data file was removed
+            self.remove_file_filters(Path(key).stem)
+            changed = True
+
+        if self.bit_sliced_bloom:
+            bloom_indexes = self.write_bloom_indexes(manifest, bloom_values)
+        else:
+            # Indexes of a previous run would not follow the filters anymore
+            bloom_indexes = {}
+            for index_path in (Path(self.filter_dir) / self.store_name).glob(f"*{BLOOM_INDEX_SUFFIX}"):
+                index_path.unlink()
+        # The metadata lists the bloom indexes of this run, servers only load those
+        for column, index_path in bloom_indexes.items():
+            metadata[column] = dict(metadata[column], bloom_index=os.path.relpath(index_path, self.filter_dir))
+
+        # Write the metadata to a JSON file, servers reload the store when it changes
+        metadata_path = Path(self.filter_dir) / 'stores_metadata' / f'{self.store_name}.json'
+        if changed or metadata != self.read_store_metadata(metadata_path):
+            metadata_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(metadata_path, 'w') as f:
+                json.dump(metadata, f)
+        self.write_manifest(settings, manifest)
 
-                columns_to_filter = self.included_columns if self.included_columns else df.columns
+    @staticmethod
+    def read_store_metadata(metadata_path):
+        try:
+            with open(metadata_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
 
-                for column in columns_to_filter:
-                    new_file_dir = Path(self.filter_dir) / self.store_name / path.stem
-                    new_file_dir.mkdir(parents=True, exist_ok=True)
+    def manifest_path(self):
+        return Path(self.filter_dir) / 'stores_metadata' / f'{self.store_name}{MANIFEST_SUFFIX}'
 
-                    # Prepare filter parameters
-                    filter_params = self.prepare_filter_params(column, path)
-                    FilterClass = self.filter_classes.get(filter_params["strategy"])
+    def manifest_key(self, path):
+        return Path(path).relative_to(self.data_dir).as_posix()
 
-                    if FilterClass is None:
-                        raise ValueError(f"No filter class for strategy '{filter_params['strategy']}'")
+    def settings_fingerprint(self):
+        """Hash of the generator settings the filters depend on"""
+        settings = {'config': self.config, 'included_columns': sorted(self.included_columns),
+                    'filter_format': self.filter_format, 'row_group_filters': self.row_group_filters}
+        return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
 
-                    # Instantiate the filter
-                    filter_instance = FilterClass.create(reader=filter_params["reader"], **filter_params["params"])
+    def read_manifest(self):
+        """Returns the settings fingerprint and the file entries of the previous run"""
+        try:
+            with open(self.manifest_path(), 'r') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None, {}
+        return manifest.get('settings'), manifest.get('files', {})
+
+    def write_manifest(self, settings, manifest):
+        self.manifest_path().parent.mkdir(parents=True, exist_ok=True)
+        with open(self.manifest_path(), 'w') as f:
+            json.dump({'settings': settings, 'files': manifest}, f, indent=1, sort_keys=True)
+
+    def update_file_filters(self, path, previous=None):
+        """
+        Brings the filters of one data file up to date with its manifest entry from the previous run.
+
+        Returns the new manifest entry, the previous one itself if nothing changed, and the unique values
+        of the bloom columns that were rebuilt for the bit-sliced index.
+        """
+        stat = os.stat(path)
+        if previous is not None and (previous['size'], previous['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+            return previous, {}
+
+        content_hash = self.content_hash(path)
+        if previous is not None and previous['hash'] == content_hash:
+            # Touched or copied but identical
+            return dict(previous, mtime_ns=stat.st_mtime_ns), {}
+
+        entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': content_hash,
+                 'row_groups': self.row_group_fingerprints(path)}
+
+        # Row group filters are rebuilt with the file, they are not extended
+        if (previous is not None and not self.row_group_filters
+                and self.is_append(previous['row_groups'], entry['row_groups'])):
+            new_row_groups = range(len(previous['row_groups']), len(entry['row_groups']))
+            filters = self.extend_file_filters(path, previous, new_row_groups)
+            if filters is not None:
+                entry['filters'] = filters
+                return entry, {}
+
+        entry['filters'], bloom_values = self.generate_file_filters(path)
+        return entry, bloom_values
 
-                    # Save the filter to disk
-                    filter_path = f"{new_file_dir}/{column}.pickle"
-                    with open(filter_path, 'wb') as f:
-                        pickle.dump(filter_instance, f)
+    @staticmethod
+    def is_append(previous_row_groups, row_groups):
+        return (previous_row_groups is not None and row_groups is not None
+                and len(row_groups) > len(previous_row_groups)
+                and row_groups[:len(previous_row_groups)] == previous_row_groups)
 
-                    # Update the metadata
-                    metadata[column] = {
-                        'filter_type': filter_params["strategy"],
-                        'relative_path': os.path.relpath(filter_path, self.filter_dir)
-                    }
+    @staticmethod
+    def content_hash(path):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def row_group_fingerprints(self, path):
+        """Returns one fingerprint per row group, used to detect appended data, or None if not supported"""
+        return None
+
+    def load_row_groups(self, path, columns, row_groups):
+        """Yields the given row groups of a data file as DataFrames"""
+        raise NotImplementedError(f'{type(self).__name__} cannot read row groups')
+
+    def extend_file_filters(self, path, previous, row_groups):
+        """
+        Folds new row groups into the existing filters of a data file.
+
+        Returns the new filters metadata, or None when a filter cannot be extended (no update method,
+        bloom filter at capacity, bloom values needed for the bit-sliced index) and must be rebuilt.
+        """
+        if self.bit_sliced_bloom and any(info['filter_type'] == BloomFilter.name
+                                         for info in previous['filters'].values()):
+            return None
+
+        filters = self.load_file_filters(path, previous['filters'])
+        if filters is None:
+            return None
 
-        # Write the metadata to a JSON file
-        os.makedirs(os.path.join(self.filter_dir, 'stores_metadata'), exist_ok=True)
-        with open(os.path.join(self.filter_dir, 'stores_metadata', f'{self.store_name}.json'), 'w') as f:
-            json.dump(metadata, f)
+        try:
+            for chunk in self.load_row_groups(path, list(filters), row_groups):
+                for column, filter_instance in filters.items():
+                    filter_instance.update(chunk[column])
+        except (AttributeError, IndexError, TypeError, ValueError):
+            return None
+
+        strategies = {column: info['filter_type'] for column, info in previous['filters'].items()}
+        return self.save_file_filters(path, filters, strategies)
+
+    def load_file_filters(self, path, filters_metadata):
+        """Loads writable copies of the saved filters of a data file, None if they are missing"""
+        filters = {}
+        try:
+            if self.filter_format == 'segment':
+                segment = SegmentReader(Path(self.filter_dir) / self.store_name / f"{path.stem}{SEGMENT_SUFFIX}")
+                try:
+                    for column in filters_metadata:
+                        # Filters read from a segment share the read-only mapping, copy them. A pickle round trip
+                        # would keep the bloom bit arrays read-only
+                        filters[column] = copy.deepcopy(segment.read(column))
+                finally:
+                    segment.close()
+            else:
+                for column in filters_metadata:
+                    with open(Path(self.filter_dir) / self.store_name / path.stem / f"{column}.pickle", 'rb') as f:
+                        filters[column] = pickle.load(f)
+        except (FileNotFoundError, KeyError, ValueError):
+            return None
+        return filters
+
+    def remove_file_filters(self, stem):
+        store_dir = Path(self.filter_dir) / self.store_name
+        (store_dir / f"{stem}{SEGMENT_SUFFIX}").unlink(missing_ok=True)
+        shutil.rmtree(store_dir / stem, ignore_errors=True)
+
+    def write_bloom_indexes(self, manifest, bloom_values):
+        """
+        Writes the bit-sliced bloom index of every bloom column and returns their paths by column.
+
+        Files that were not rebuilt keep their bits from the previous index when its sizing still fits,
+        otherwise their column is read again.
+        """
+        store_dir = Path(self.filter_dir) / self.store_name
+        index_paths = {}
+        files_by_column = {}
+        for key, entry in manifest.items():
+            for column, info in entry['filters'].items():
+                if info['filter_type'] == BloomFilter.name:
+                    files_by_column.setdefault(column, {})[Path(key).stem] = key
+
+        for index_path in store_dir.glob(f"*{BLOOM_INDEX_SUFFIX}"):
+            if index_path.stem not in files_by_column:
+                index_path.unlink()
+
+        for column, files in files_by_column.items():
+            values_by_file = bloom_values.get(column, {})
+            index_path = index_paths[column] = store_dir / f"{column}{BLOOM_INDEX_SUFFIX}"
+            base = BitSlicedBloomIndex.load(index_path) if index_path.exists() else None
+            kept = [file for file in files if file not in values_by_file]
+            if base is not None and not values_by_file and set(base.files) == set(files):
+                continue  # Nothing changed for this column
+
+            params = dict(self.config.get(column, {}).get("params", {}))
+            needed = max([len(values) for values in values_by_file.values()] + [1])
+            if (base is not None and base.capacity is not None and needed <= base.capacity
+                    and base.file_set.issuperset(kept)
+                    and (base.error_rate, base.data_type) == (params.get('error_rate', 0.1),
+                                                              params.get('data_type', 'str'))):
+                index = BitSlicedBloomIndex.build(values_by_file, capacity=base.capacity, base=base, base_files=kept,
+                                                  **params)
+            else:
+                values_by_file = dict(values_by_file)
+                for file in kept:
+                    reader = self.load_data(Path(self.data_dir) / files[file], columns=[column],
+                                            chunksize=self.DEFAULT_CHUNK_SIZE)
+                    values_by_file[file] = BloomFilter.unique_values(reader, params.get('data_type', 'str'))
+                index = BitSlicedBloomIndex.build(values_by_file, **params)
+            index.save(index_path)
+        return index_paths
+
+    def generate_file_filters(self, path):
+        """
+        Generates and saves the filters of every column of one data file.
+
+        The file is read once: each decoded chunk feeds the builders of all its columns. Strategies that
+        are not configured are selected from the first SAMPLE_SIZE rows, which are kept in memory until
+        the decision is made.
+
+        Returns the metadata of the file's filters and, for bit-sliced bloom indexes, the unique values
+        of its bloom columns.
+        """
+        bloom_values = {}
+
+        columns = self.get_columns(path)
+        if self.included_columns:
+            columns = [column for column in columns if column in self.included_columns]
+
+        # Skip if data is empty
+        if not columns:
+            return {}, bloom_values
+
+        # Configured columns whose filter can be built from the file metadata alone are never decoded
+        footer = self.read_footer(path)
+        filters = {}
+        strategies = {}
+        column_params = {}
+        for column in columns:
+            if column in self.config:
+                strategy, params = self.select_filter_strategy(column, None)
+                filter_instance = self.filter_from_metadata(footer, column, strategy, params)
+                if filter_instance is not None:
+                    filters[column] = filter_instance
+                    strategies[column] = strategy
+                    column_params[column] = params
+
+        builders = {}
+        row_group_filters = {}  # column -> filter of every row group, when row group filters are enabled
+        scan_columns = [column for column in columns if column not in filters]
+        if scan_columns:
+            chunks = self.load_data(path, columns=scan_columns, chunksize=self.DEFAULT_CHUNK_SIZE)
+
+            # Buffer a bounded sample for the strategy selection
+            sample = []
+            sample_rows = 0
+            for chunk in chunks:
+                sample.append(chunk)
+                sample_rows += len(chunk)
+                if sample_rows >= self.SAMPLE_SIZE:
+                    break
+
+            if not sample_rows:
+                return {}, bloom_values
+
+            for column in scan_columns:
+                strategy, params = self.select_filter_strategy(column, sample)
+                FilterClass = self.filter_classes.get(strategy)
+
+                if FilterClass is None:
+                    raise ValueError(f"No filter class for strategy '{strategy}'")
+
+                strategies[column] = strategy
+                column_params[column] = params
+                filter_instance = self.filter_from_metadata(footer, column, strategy, params)
+                if filter_instance is not None:
+                    filters[column] = filter_instance
+                else:
+                    builders[column] = FilterClass.builder(**params)
+
+            # Feed the sample, then the rest of the file, to every column builder
+            chunks = self.remaining_chunks(path, list(builders), chunks, len(sample))
+            for chunk in itertools.chain(sample, chunks):
+                for column, builder in builders.items():
+                    builder.add(chunk[column])
+                    if self.row_group_filters:
+                        # Chunks are row groups
+                        row_group_builder = self.filter_classes[strategies[column]].builder(**column_params[column])
+                        row_group_builder.add(chunk[column])
+                        row_group_filters.setdefault(column, []).append(row_group_builder.build())
+            sample = None
+
+        if self.row_group_filters:
+            for column in filters:
+                # Filters built from the metadata get their row group filters from it too
+                column_row_groups = [self.filter_from_metadata(footer, column, strategies[column],
+                                                               column_params[column], row_groups=[i])
+                                     for i in range(self.row_group_count(footer))]
+                if all(filter_instance is not None for filter_instance in column_row_groups):
+                    row_group_filters[column] = column_row_groups
+
+        for column, builder in builders.items():
+            filters[column] = builder.build()
+            if self.bit_sliced_bloom and isinstance(filters[column], BloomFilter):
+                # Keep the values around to build the store wide bit-sliced index afterwards
+                bloom_values[column] = builder.values
+
+        # Keep the column order of the file
+        filters = {column: filters[column] for column in columns}
+        return self.save_file_filters(path, filters, strategies, row_group_filters), bloom_values
+
+    def save_file_filters(self, path, filters, strategies, row_group_filters=None):
+        """Saves the filters of a data file, and optionally of its row groups, and returns their metadata"""
+        metadata = {}
+
+        # Segment format: every column filter of this file is packed in one file
+        segment = None
+        if self.filter_format == 'segment':
+            segment = SegmentWriter(Path(self.filter_dir) / self.store_name / f"{path.stem}{SEGMENT_SUFFIX}")
+
+        for column, filter_instance in filters.items():
+            # Save the filter to disk
+            if segment is not None:
+                segment.add(column, filter_instance)
+                for row_group, row_group_filter in enumerate((row_group_filters or {}).get(column, ())):
+                    segment.add(column, row_group_filter, row_group=row_group)
+                filter_path = segment.path
+            else:
+                new_file_dir = Path(self.filter_dir) / self.store_name / path.stem
+                new_file_dir.mkdir(parents=True, exist_ok=True)
+                filter_path = f"{new_file_dir}/{column}.pickle"
+                with open(filter_path, 'wb') as f:
+                    pickle.dump(filter_instance, f)
+
+            # Update the metadata
+            metadata[column] = {
+                'filter_type': strategies[column],
+                'relative_path': os.path.relpath(filter_path, self.filter_dir)
+            }
+
+        if segment is not None:
+            segment.close()
+
+        return metadata
 
     @abstractmethod
     def get_files(self, root):
@@ -124,21 +485,44 @@ class AbstractFilterGenerator(ABC):
     def load_data(self, path, columns=None, chunksize=None):
         pass
 
-    def prepare_filter_params(self, column, path):
-        filter_params = {}
-        reader_for_selector = self.load_data(path, columns=[column], chunksize=self.DEFAULT_CHUNK_SIZE)
+    def get_columns(self, path):
+        """Returns the columns of a data file, or an empty list if it holds no data"""
+        df = next(self.load_data(path, chunksize=10), None)
+        if df is None or df.empty:
+            return []
+        return list(df.columns)
+
+    def read_footer(self, path):
+        """Returns the file level metadata used by filter_from_metadata, None if the format has none"""
+        return None
+
+    def filter_from_metadata(self, footer, column, strategy, params, row_groups=None):
+        """
+        Builds a filter from the file metadata without reading data, None if it is not possible.
 
+        row_groups restricts the filter to some row groups, by default it covers the whole file.
+        """
+        return None
+
+    def row_group_count(self, footer):
+        return 0
+
+    def remaining_chunks(self, path, columns, chunks, consumed):
+        """
+        Returns the chunks left after the first consumed ones, only columns are still needed.
+
+        Formats that can read a subset of the file override this to stop decoding the other columns.
+        """
+        return chunks
+
+    def select_filter_strategy(self, column, sample):
+        """Returns the (strategy, params) pair for a column, from the config or from a sample of chunks"""
         if column in self.config:
             filter_info = self.config[column]
-            filter_strategy = filter_info["strategy"]
-            if "params" in filter_info:
-                filter_params = filter_info["params"]
-        else:
-            selector = FilterSelector(reader_for_selector, column)
-            filter_strategy = selector.select_filter_strategy(self.BLOOM_THRESHOLD, self.SET_THRESHOLD)
+            return filter_info["strategy"], filter_info.get("params", {})
 
-        reader_for_filter = self.load_data(path, columns=[column], chunksize=self.DEFAULT_CHUNK_SIZE)
-        return {"strategy": filter_strategy, "params": filter_params, "reader": reader_for_filter}
+        selector = FilterSelector(sample, column)
+        return selector.select_filter_strategy(self.BLOOM_THRESHOLD, self.SET_THRESHOLD), {}
 
     def override_filter_strategy(self, column, filter_strategy, params=None):
         """Overrides the filter strategy for a specified column"""
@@ -148,10 +532,125 @@ class AbstractFilterGenerator(ABC):
 
 
 class ParquetFilterGenerator(AbstractFilterGenerator):
+    SUPPORTS_ROW_GROUPS = True
+    STATISTICS_PHYSICAL_TYPES = ('INT32', 'INT64', 'FLOAT', 'DOUBLE')
+    RANGE_LOGICAL_TYPES = ('NONE', 'INT')
+    DATE_LOGICAL_TYPES = ('DATE', 'TIMESTAMP')
 
     def get_files(self, root):
         return [file for file in os.listdir(root) if file.endswith('.parquet')]
 
+    def get_columns(self, path):
+        # The schema and row count are in the footer, no data needs to be decoded
+        parquet_file = pq.ParquetFile(path)
+        if parquet_file.metadata.num_rows == 0:
+            return []
+        return parquet_file.schema_arrow.names
+
+    def read_footer(self, path):
+        return pq.ParquetFile(path).metadata
+
+    def filter_from_metadata(self, footer, column, strategy, params, row_groups=None):
+        # Range and date filters only need min/max, which are in the row group statistics
+        if strategy == RangeFilter.name:
+            bounds = self.column_bounds(footer, column, self.RANGE_LOGICAL_TYPES, row_groups)
+            if bounds is not None:
+                return RangeFilter({'min': bounds[0], 'max': bounds[1]})
+        elif strategy == DateFilter.name:
+            bounds = self.column_bounds(footer, column, self.DATE_LOGICAL_TYPES, row_groups)
+            if bounds is not None:
+                date_format = params.get('date_format', '%Y-%m-%d')
+                timezone = self.column_timezone(footer, column)
+                min_date, max_date = (self.to_date(value, timezone) for value in bounds)
+                return DateFilter({'min': min_date.strftime(date_format), 'max': max_date.strftime(date_format),
+                                   'date_format': date_format})
+        return None
+
+    def row_group_count(self, footer):
+        return footer.num_row_groups
+
+    @staticmethod
+    def column_timezone(footer, column):
+        """Returns the time zone of a timestamp column, the one its values are read in, None if it has none"""
+        return getattr(footer.schema.to_arrow_schema().field(column).type, 'tz', None)
+
+    @staticmethod
+    def to_date(value, timezone=None):
+        # Statistics of timestamps with a time zone are in UTC, take the date in the zone the scan reads them in
+        if isinstance(value, datetime):
+            if timezone is not None and value.tzinfo is not None:
+                return pd.Timestamp(value).tz_convert(timezone).date()
+            return value.date()
+        return value
+
+    @staticmethod
+    def column_bounds(footer, column, logical_types, row_groups=None):
+        """
+        Returns the (min, max) of a column from the statistics of row_groups (by default all of them).
+
+        Returns None, so that the column is scanned instead, when a row group has no statistics, when they
+        are truncated or when the column type does not have a trustworthy ordering.
+        """
+        positions = [j for j in range(footer.num_columns) if footer.schema.column(j).path == column]
+        if len(positions) != 1:
+            return None
+        j = positions[0]
+        schema_column = footer.schema.column(j)
+        if schema_column.physical_type not in ParquetFilterGenerator.STATISTICS_PHYSICAL_TYPES:
+            return None
+        if schema_column.logical_type.type not in logical_types:
+            return None
+
+        min_val = max_val = None
+        for i in range(footer.num_row_groups) if row_groups is None else row_groups:
+            row_group = footer.row_group(i)
+            statistics = row_group.column(j).statistics
+            if row_group.num_rows == 0:
+                continue
+            if statistics is None:
+                return None
+            if statistics.has_null_count and statistics.null_count == row_group.num_rows:
+                continue  # Only nulls, they never match
+            if not statistics.has_min_max:
+                return None
+            if not getattr(statistics, 'is_min_value_exact', True) or not getattr(statistics, 'is_max_value_exact', True):
+                return None
+            min_val = statistics.min if min_val is None else min(min_val, statistics.min)
+            max_val = statistics.max if max_val is None else max(max_val, statistics.max)
+
+        if min_val is None:
+            return None
+        return min_val, max_val
+
+    def remaining_chunks(self, path, columns, chunks, consumed):
+        # Chunks are row groups, read the following ones with only the columns that still need data
+        chunks.close()
+        if not columns:
+            return iter(())
+        return self.load_row_groups(path, columns, range(consumed, pq.ParquetFile(path).num_row_groups))
+
+    def row_group_fingerprints(self, path):
+        # Row group layout and statistics from the footer, rewriting a row group changes its fingerprint
+        metadata = pq.ParquetFile(path).metadata
+        fingerprints = []
+        for i in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i)
+            digest = hashlib.sha1(f"{row_group.num_rows}:{row_group.total_byte_size}".encode())
+            for j in range(row_group.num_columns):
+                column = row_group.column(j)
+                statistics = column.statistics
+                digest.update(f"{column.path_in_schema}:{column.total_compressed_size}:"
+                              f"{statistics.min if statistics is not None and statistics.has_min_max else None}:"
+                              f"{statistics.max if statistics is not None and statistics.has_min_max else None}"
+                              .encode())
+            fingerprints.append(digest.hexdigest())
+        return fingerprints
+
+    def load_row_groups(self, path, columns, row_groups):
+        parquet_file = pq.ParquetFile(path)
+        for i in row_groups:
+            yield parquet_file.read_row_group(i, columns=columns).to_pandas()
+
     def load_data(self, path, columns=None, chunksize=None):
         # Create a generator to read chunks from the file
         if chunksize:
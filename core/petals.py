@@ -1,20 +1,41 @@
+import asyncio
+import collections
+import glob
+import json
 import os
 import pickle
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+from bitarray import bitarray
 
 try:
-    from boto.roboto.awsqueryservice import NoCredentialsError
-    from dask.bytes.tests.test_s3 import boto3
-except:pass
+    import boto3
+except ImportError:
+    # Only needed by S3PetalsServer without an explicit S3 client
+    boto3 = None
 
+from core.bloom_index import BLOOM_INDEX_SUFFIX, BitSlicedBloomIndex
+from core.filter_cache import FilterCache
+from core.filters import Filter
+from core.planner import QueryPlanner, condition_key, normalize_condition
+from core.result_cache import ResultCache
+from core.segment import SEGMENT_SUFFIX, SegmentReader, replace_atomically
 from core.server import KVServer
-from core.trie import Trie
 from core.utils import ensure_json_output, TCPMessage, get_filter_classes
 from abc import ABC, abstractmethod
 
 
 def create_filter(data):
+    # Pickled filters and segment entries are already built
+    if isinstance(data, Filter):
+        return data
+
     filter_classes = get_filter_classes()
     filter_type = data['type']
     if filter_type not in filter_classes:
@@ -23,12 +44,154 @@ def create_filter(data):
     return filter_classes[filter_type](data)
 
 
+def empty_bitmap(size):
+    bitmap = bitarray(size)
+    bitmap.setall(0)
+    return bitmap
+
+
+def bitmap_from_ids(file_ids, size):
+    """Builds a bitmap of the given size with the bits of file_ids (a NumPy integer array) set"""
+    mask = np.zeros(size, dtype=bool)
+    mask[file_ids] = True
+    bitmap = bitarray()
+    bitmap.frombytes(np.packbits(mask).tobytes())
+    del bitmap[size:]
+    return bitmap
+
+
+class QueryBatch:
+    """
+    State shared by the queries of one query_batch message.
+
+    Filters are loaded once and pinned for the whole batch, and every rule remembers the files it was
+    already tested on, so a rule repeated across queries is never tested twice on the same file.
+    """
+
+    def __init__(self, generation=0):
+        self.reset(generation)
+
+    def reset(self, generation):
+        """Drops the shared state, which belongs to an older generation of the loaded stores"""
+        self.generation = generation  # AbstractPetalsServer.generation the state below belongs to
+        self.filters = {}  # filter key -> filter
+        self.rules = {}  # (store, rule key) -> (bitmap of the tested files, bitmap of the matching ones)
+
+
+class StateLock:
+    """
+    Readers-writer lock over the loaded stores: any number of query evaluations run together, while a
+    reload waits for the running ones to finish and holds new ones back.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writers = 0  # waiting or running
+
+    @contextmanager
+    def reading(self):
+        with self._condition:
+            while self._writers:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def writing(self):
+        with self._condition:
+            self._writers += 1
+            while self._readers:
+                self._condition.wait()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writers -= 1
+                self._condition.notify_all()
+
+
+# Server of a query worker process, see AbstractPetalsServer.worker_spec
+_worker_server = None
+
+
+def _start_query_worker(server_class, args, kwargs):
+    global _worker_server
+    _worker_server = server_class(*args, query_executor=None, **kwargs)
+
+
+def _evaluate_in_worker(method, args):
+    return getattr(_worker_server, method)(*args)
+
+
+def _evaluate_chunks_in_worker(method, args):
+    return list(getattr(_worker_server, method)(*args))
+
+
 class AbstractPetalsServer(KVServer, ABC):
-    data = Trie()
+    """
+    Answers queries over the filters of the stores.
+
+    Queries are evaluated off the event loop, on query_executor: 'thread' (default, suited to filters loaded
+    from disk or S3), 'process' (worker processes with their own copy of the stores, for CPU bound filters)
+    or None to evaluate on the event loop. At most max_concurrent_queries evaluations run at once, the
+    others wait without holding a worker.
+    expirable_dict_path, default_ttl and hot_tier_size configure the KV store, see KVServer.
+    """
 
-    def __init__(self, host, port):
-        super().__init__(host, port)
+    FILTER_CACHE_SIZE = 512 * 1024 * 1024  # bytes
+    RESULT_CACHE_SIZE = 1024  # entries
+    RESULT_CACHE_TTL = 60  # seconds
+    QUERY_EXECUTORS = ('thread', 'process', None)
+    STREAM_CHUNK_SIZE = 10000  # result entries per chunk of a streamed query
+
+    def __init__(self, host, port, filter_cache_size=None, result_cache_size=None, result_cache_ttl=None,
+                 query_executor='thread', query_workers=None, max_concurrent_queries=None,
+                 expirable_dict_path="kvserver.db", default_ttl=60, hot_tier_size=None):
+        if query_executor not in self.QUERY_EXECUTORS:
+            raise ValueError(f"Invalid query executor '{query_executor}'")
+        super().__init__(host, port, expirable_dict_path=expirable_dict_path, default_ttl=default_ttl,
+                         hot_tier_size=hot_tier_size)
+        # Constructor options handed over to query worker processes, they never serve the KV store from a hot tier
+        self.options = {'filter_cache_size': filter_cache_size, 'result_cache_size': result_cache_size,
+                        'result_cache_ttl': result_cache_ttl, 'expirable_dict_path': expirable_dict_path,
+                        'default_ttl': default_ttl}
+        self.query_executor = query_executor
+        self.query_workers = query_workers or os.cpu_count() or 1
+        self.max_concurrent_queries = max_concurrent_queries or self.query_workers
+        self.executor = None
+        self.query_slots = None
+        self.state_lock = StateLock()
+        # Incremented by every reload, file ids and loaded filters of an older generation are stale
+        self.generation = 0
+        # store -> file names, the position of a name is its file id
+        self.store_files = {}
+        # store -> {file name: file id}
+        self.file_ids = {}
+        # store -> column -> {file id: filter key}
+        self.index = {}
+        # store -> column -> bitmap of the files having a filter for column, see build_file_bitmaps
+        self.column_masks = {}
+        # (store, column) -> BitSlicedBloomIndex
+        self.bloom_indexes = {}
+        # (store, column) -> (file id of every bloom index position, bitmap of the files it covers)
+        self.bloom_maps = {}
+        # (store, file name) -> (row group count, columns having a filter per row group)
+        self.row_groups = {}
+        self.filter_cache = FilterCache(filter_cache_size or self.FILTER_CACHE_SIZE)
+        self.planner = QueryPlanner(self)
+        self.result_cache = ResultCache(self.RESULT_CACHE_SIZE if result_cache_size is None else result_cache_size,
+                                        self.RESULT_CACHE_TTL if result_cache_ttl is None else result_cache_ttl)
+        self.store_versions = {}
         self.load_data()
+        self.build_file_bitmaps()
+        self.refresh_store_versions()
 
     @abstractmethod
     def load_data(self):
@@ -38,35 +201,399 @@ class AbstractPetalsServer(KVServer, ABC):
     def load_raw_data(self, keys):
         pass
 
+    def unload_data(self):
+        """Releases what load_data opened, called by reload_data under the state write lock"""
+
+    def store_version(self, store):
+        """Returns a token that changes whenever the filters of store are regenerated, None if unknown"""
+        return None
+
+    def refresh_store_versions(self):
+        self.store_versions = {store: self.store_version(store) for store in self.store_files}
+
+    def reload_data(self):
+        """Drops every loaded filter and cached result, then loads the stores again"""
+        self.generation += 1
+        self.unload_data()
+        self.store_files = {}
+        self.file_ids = {}
+        self.index = {}
+        self.bloom_indexes = {}
+        self.row_groups = {}
+        self.filter_cache.invalidate()
+        self.result_cache.invalidate()
+        self.load_data()
+        self.build_file_bitmaps()
+        self.refresh_store_versions()
+
+    def file_id(self, store, filename):
+        """Returns the dense integer id of a file, assigning the next one on first sight"""
+        ids = self.file_ids.setdefault(store, {})
+        if filename not in ids:
+            ids[filename] = len(ids)
+            self.store_files.setdefault(store, []).append(filename)
+        return ids[filename]
+
+    def register_filter(self, store, filename, column):
+        """Registers a filter in the per-store column index, its data is only loaded on first use"""
+        key = (store, filename, column)
+        self.index.setdefault(store, {}).setdefault(column, {})[self.file_id(store, filename)] = key
+        self.result_cache.invalidate(store)
+        return key
+
+    def register_bloom_index(self, store, column, index):
+        """Registers a bit-sliced bloom index, used instead of the per-file filters of the files it covers"""
+        self.bloom_indexes[(store, column)] = index
+        for filename in index.files:
+            self.file_id(store, filename)
+        self.result_cache.invalidate(store)
+
+    def register_row_group_filters(self, store, filename, count, columns):
+        """Registers the per row group filters of a file, loaded on first use like file filters"""
+        self.row_groups[(store, filename)] = (count, set(columns))
+        self.result_cache.invalidate(store)
+
+    def build_file_bitmaps(self):
+        """Builds the per-column bitmaps once every file of every store has its id"""
+        self.column_masks = {}
+        for store, columns in self.index.items():
+            size = len(self.store_files[store])
+            for column, filters in columns.items():
+                mask = empty_bitmap(size)
+                for file_id in filters:
+                    mask[file_id] = 1
+                self.column_masks.setdefault(store, {})[column] = mask
+
+        self.bloom_maps = {}
+        for (store, column), index in self.bloom_indexes.items():
+            positions = np.array([self.file_ids[store][filename] for filename in index.files], dtype=np.int64)
+            covered = bitmap_from_ids(positions, len(self.store_files[store]))
+            self.bloom_maps[(store, column)] = (positions, covered)
+
+    def all_files(self, store) -> bitarray:
+        bitmap = empty_bitmap(len(self.store_files.get(store, ())))
+        bitmap.setall(1)
+        return bitmap
+
+    def file_names(self, store, bitmap: bitarray) -> list:
+        names = self.store_files.get(store, [])
+        return [names[file_id] for file_id in bitmap.search(1)]
+
     def load_column_data(self, keys):
         data = self.load_raw_data(keys)
         return create_filter(data)
 
-    def process_condition(self, condition: Dict, store: str) -> set:
+    def load_filters(self, keys: list, batch: Optional[QueryBatch] = None) -> Iterator[Filter]:
+        """Yields the filters of keys in order, a server may load the next ones meanwhile"""
+        for key in keys:
+            yield self.get_filter(key, batch)
+
+    def get_filter(self, key, batch: Optional[QueryBatch] = None) -> Filter:
+        if batch is None:
+            return self.filter_cache.get(key, self.load_column_data)
+        filter = batch.filters.get(key)
+        if filter is None:
+            filter = batch.filters[key] = self.filter_cache.get(key, self.load_column_data)
+        return filter
+
+    def process_condition(self, condition: Dict, store: str, candidates: Optional[bitarray] = None,
+                          batch: Optional[QueryBatch] = None) -> bitarray:
+        """
+        Returns the bitmap, indexed by file id, of the files of store that may satisfy condition.
+
+        When candidates is given, only those files are probed: the result is always a subset of it.
+        Within a batch, filters and rule results are shared with the other queries of the batch.
+        """
+        if candidates is None:
+            candidates = self.all_files(store)
+
+        if 'condition' in condition and 'rules' in condition:
+            # This is a composite condition, the planner decides the order of its rules
+            rules = self.planner.order(condition, store)
+            if condition['condition'] == 'and':
+                # Each rule only probes the files that survived the previous ones
+                for rule in rules:
+                    if not candidates.any():
+                        break
+                    candidates = self.process_condition(rule, store, candidates, batch)
+                return candidates
+            else:  # condition['condition'] == 'or'
+                # Each rule skips the files that already matched an earlier one
+                remaining = candidates.copy()
+                relevant_files = empty_bitmap(len(candidates))
+                for rule in rules:
+                    if not remaining.any():
+                        break
+                    matched = self.process_condition(rule, store, remaining, batch)
+                    relevant_files |= matched
+                    remaining &= ~matched
+                return relevant_files
+        elif batch is not None:
+            # Only test the files this rule was not tested on by an earlier query of the batch
+            rule_key = (store, condition_key(condition))
+            tested, matched = batch.rules.get(rule_key, (empty_bitmap(len(candidates)), empty_bitmap(len(candidates))))
+            untested = candidates & ~tested
+            relevant_files = candidates & matched
+            if untested.any():
+                newly_matched = self.process_rule(condition, store, untested, batch)
+                batch.rules[rule_key] = (tested | untested, matched | newly_matched)
+                relevant_files |= newly_matched
+            return relevant_files
+        else:
+            return self.process_rule(condition, store, candidates)
+
+    def process_rule(self, condition: Dict, store: str, candidates: bitarray,
+                     batch: Optional[QueryBatch] = None) -> bitarray:
+        """Returns the bitmap of the candidates that may satisfy a single rule"""
+        field = condition['field']
+        operator = condition.get('operator', '=')
+        value = condition['value']
+        relevant_files = empty_bitmap(len(candidates))
+        filters = self.index.get(store, {}).get(field, {})
+        to_probe = candidates & self.column_masks.get(store, {}).get(field, relevant_files)
+
+        probed = matched_count = 0
+        bloom_index = self.bloom_indexes.get((store, field))
+        if bloom_index is not None:
+            positions, covered = self.bloom_maps[(store, field)]
+            if operator == '=':
+                relevant_files = bitmap_from_ids(positions[bloom_index.candidate_mask(value)], len(candidates))
+            elif operator == 'in':
+                relevant_files = bitmap_from_ids(positions[bloom_index.candidate_mask_any(value)],
+                                                 len(candidates))
+            else:
+                # Bloom filters only answer equality, every covered file may match
+                relevant_files = covered.copy()
+            relevant_files &= candidates
+            probed = (candidates & covered).count()
+            matched_count = relevant_files.count()
+            to_probe &= ~covered
+
+        file_ids = list(to_probe.search(1))
+        for file_id, filter in zip(file_ids, self.load_filters([filters[file_id] for file_id in file_ids], batch)):
+            if filter.test_operator(operator, value):
+                relevant_files[file_id] = 1
+                matched_count += 1
+        self.planner.record(store, field, probed + to_probe.count(), matched_count, operator)
+        return relevant_files
+
+    def process_row_groups(self, condition: Dict, store: str, filename: str,
+                           candidates: Optional[bitarray] = None,
+                           batch: Optional[QueryBatch] = None) -> Optional[bitarray]:
+        """
+        Returns the bitmap of the row groups of a file that may satisfy condition, None if the file has no
+        row group filters. Columns without row group filters cannot prune any row group.
+        """
+        if (store, filename) not in self.row_groups:
+            return None
+        count, columns = self.row_groups[(store, filename)]
+        if candidates is None:
+            candidates = empty_bitmap(count)
+            candidates.setall(1)
+
         if 'condition' in condition and 'rules' in condition:
-            # This is a composite condition
-            sets = [self.process_condition(rule, store) for rule in condition['rules']]
+            rules = self.planner.order(condition, store)
             if condition['condition'] == 'and':
-                return set.intersection(*sets)
+                for rule in rules:
+                    if not candidates.any():
+                        break
+                    candidates = self.process_row_groups(rule, store, filename, candidates, batch)
+                return candidates
             else:  # condition['condition'] == 'or'
-                return set.union(*sets)
+                remaining = candidates.copy()
+                relevant_row_groups = empty_bitmap(count)
+                for rule in rules:
+                    if not remaining.any():
+                        break
+                    matched = self.process_row_groups(rule, store, filename, remaining, batch)
+                    relevant_row_groups |= matched
+                    remaining &= ~matched
+                return relevant_row_groups
         else:
-            # This is a single condition
             field = condition['field']
+            operator = condition.get('operator', '=')
             value = condition['value']
-            relevant_files = set()
-            for keys in self.data.keys():
-                store_name, file_name, column_file = keys.split('/')
-                if store_name == store and column_file.startswith(field):
-                    filter = self.data.search([store, file_name, column_file])
-                    if filter is None:
-                        filter = self.load_column_data([store, file_name, column_file])
-                        self.data.insert([store, file_name, column_file], filter)
-                    if filter.test(value):
-                        relevant_files.add(file_name)
-            return relevant_files
+            if field not in columns:
+                return candidates
+            relevant_row_groups = empty_bitmap(count)
+            for row_group in candidates.search(1):
+                filter = self.get_filter((store, filename, field, row_group), batch)
+                if filter.test_operator(operator, value):
+                    relevant_row_groups[row_group] = 1
+            return relevant_row_groups
+
+    def check_store_version(self, store: str):
+        """Reloads the stores when the filters of store were regenerated since they were loaded"""
+        version = self.store_version(store)
+        if version != self.store_versions.get(store):
+            with self.state_lock.writing():
+                # Another evaluation may have reloaded while this one waited
+                if version != self.store_versions.get(store):
+                    self.reload_data()
+                    self.store_versions[store] = version
+
+    def query(self, store: str, query: Dict, row_groups: bool = False, batch: Optional[QueryBatch] = None) -> list:
+        """
+        Evaluates a query, answering repeated queries from the result cache.
+
+        Returns the matching file names, or with row_groups [file name, row group ids] pairs where the row
+        group ids are None for files without row group filters.
+        """
+        self.check_store_version(store)
+        query = normalize_condition(query)
+        key = condition_key(query) + ('#row_groups' if row_groups else '')
+        relevant_files = self.result_cache.get(store, key)
+        if relevant_files is None:
+            with self.state_lock.reading():
+                if batch is not None and batch.generation != self.generation:
+                    batch.reset(self.generation)
+                relevant_files = self.file_names(store, self.process_condition(query, store, batch=batch))
+                if row_groups:
+                    relevant_files = [self.match_row_groups(query, store, filename, batch)
+                                      for filename in relevant_files]
+                    relevant_files = [match for match in relevant_files if match[1] is None or match[1]]
+                # Before leaving the lock, a reload would clear the cache and this result with it
+                self.result_cache.put(store, key, relevant_files)
+        return list(relevant_files)
+
+    def query_chunks(self, store: str, query: Dict, row_groups: bool = False,
+                     chunk_size: Optional[int] = None) -> Iterator[list]:
+        """
+        Evaluates a query like query, but yields its result in lists of at most chunk_size entries.
+
+        The files are evaluated in windows of file ids, the first one chunk_size files long and every next one
+        twice as long as the previous: the first chunks are sent before most files were tested, and composite
+        conditions only run about log2(files / chunk_size) times. Names, and row groups with row_groups, are
+        resolved one chunk at a time as the chunks are consumed, so the whole result is never held at once.
+        The result cache is read, but a streamed result is not added to it. chunk_size can only lower
+        STREAM_CHUNK_SIZE.
+        """
+        chunk_size = max(1, min(chunk_size or self.STREAM_CHUNK_SIZE, self.STREAM_CHUNK_SIZE))
+        self.check_store_version(store)
+        query = normalize_condition(query)
+        with self.state_lock.reading():
+            # Read together with the generation, the cached result and the names belong to the same one
+            cached = self.result_cache.get(store, condition_key(query) + ('#row_groups' if row_groups else ''))
+            generation = self.generation
+            # A reload replaces the name lists, this one stays valid for the file ids of this generation
+            names = self.store_files.get(store, [])
+        if cached is not None:
+            for start in range(0, len(cached), chunk_size):
+                yield list(cached[start:start + chunk_size])
+            return
+
+        chunk = []
+        start, window = 0, chunk_size
+        while start < len(names):
+            end = min(start + window, len(names))
+            with self.state_lock.reading():
+                self.check_generation(store, generation)
+                candidates = empty_bitmap(len(names))
+                candidates[start:end] = 1
+                relevant_files = self.process_condition(query, store, candidates)
+            for file_id in relevant_files.search(1, start, end):
+                chunk.append(names[file_id])
+                if len(chunk) == chunk_size:
+                    if row_groups:
+                        chunk = self.match_row_groups_chunk(query, store, chunk, generation)
+                    if chunk:
+                        yield chunk
+                    chunk = []
+            start, window = end, window * 2
+        if row_groups and chunk:
+            chunk = self.match_row_groups_chunk(query, store, chunk, generation)
+        if chunk:
+            yield chunk
+
+    def check_generation(self, store: str, generation: int):
+        if generation != self.generation:
+            raise RuntimeError(f"The filters of store '{store}' were reloaded while streaming its result")
+
+    def match_row_groups_chunk(self, query: Dict, store: str, filenames: list, generation: int) -> list:
+        """Returns the [file name, row group ids] pairs of the files that keep matching row groups"""
+        with self.state_lock.reading():
+            self.check_generation(store, generation)
+            matches = [self.match_row_groups(query, store, filename) for filename in filenames]
+        return [match for match in matches if match[1] is None or match[1]]
+
+    def match_row_groups(self, query: Dict, store: str, filename: str, batch: Optional[QueryBatch] = None) -> list:
+        row_groups = self.process_row_groups(query, store, filename, batch=batch)
+        return [filename, None if row_groups is None else list(row_groups.search(1))]
+
+    def query_batch(self, entries: List[Dict]) -> list:
+        """
+        Evaluates a list of {"store", "query", "row_groups"} entries and returns their results in order.
+
+        The queries share their filters and rule results, see QueryBatch.
+        """
+        for entry in entries:
+            # Reject the batch before evaluating anything
+            normalize_condition(entry['query'])
+        batch = QueryBatch(self.generation)
+        return [self.query(entry['store'], entry['query'], entry.get('row_groups', False), batch)
+                for entry in entries]
+
+    def worker_spec(self):
+        """Returns the (server class, positional arguments, keyword arguments) building a query worker"""
+        raise NotImplementedError(f'{type(self).__name__} does not support query worker processes')
 
-    async def init_handlers(self):
+    def get_executor(self):
+        if self.executor is None:
+            if self.query_executor == 'process':
+                self.executor = ProcessPoolExecutor(self.query_workers, initializer=_start_query_worker,
+                                                    initargs=self.worker_spec())
+            else:
+                self.executor = ThreadPoolExecutor(self.query_workers, thread_name_prefix='query')
+        return self.executor
+
+    async def evaluate(self, method: str, *args):
+        """Runs getattr(self, method)(*args), a query evaluation, on the query executor"""
+        if self.query_executor is None:
+            return getattr(self, method)(*args)
+
+        if self.query_executor == 'process':
+            return await self.evaluate_in_slot(_evaluate_in_worker, method, args)
+        return await self.evaluate_in_slot(getattr(self, method), *args)
+
+    async def evaluate_chunks(self, method: str, *args):
+        """
+        Iterates over getattr(self, method)(*args), a generator of result chunks, computing every chunk on the
+        query executor. A query slot is only held while a chunk is computed, not while it is sent.
+        """
+        if self.query_executor == 'process':
+            # Generators cannot be stepped across processes, the worker returns every chunk at once
+            for chunk in await self.evaluate_in_slot(_evaluate_chunks_in_worker, method, args):
+                yield chunk
+            return
+
+        chunks = getattr(self, method)(*args)
+        try:
+            while True:
+                if self.query_executor is None:
+                    # Let the previous chunk be sent before blocking the event loop on the next one
+                    await asyncio.sleep(0)
+                    chunk = next(chunks, None)
+                else:
+                    chunk = await self.evaluate_in_slot(next, chunks, None)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            chunks.close()
+
+    async def evaluate_in_slot(self, func, *args):
+        """Runs func(*args) on the query executor once one of the max_concurrent_queries slots is free"""
+        if self.query_slots is None:
+            self.query_slots = asyncio.Semaphore(self.max_concurrent_queries)
+        async with self.query_slots:
+            return await asyncio.get_running_loop().run_in_executor(self.get_executor(), func, *args)
+
+    async def shutdown(self, timeout=10):
+        await super().shutdown(timeout)
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def init_handlers(self):
         super().init_handlers()
 
         @self.message_handler('query')
@@ -74,27 +601,88 @@ class AbstractPetalsServer(KVServer, ABC):
         async def query_handler(message: TCPMessage):
             store = message.payload['store']
             query = message.payload['query']
-            relevant_files = self.process_condition(query, store)
-            return list(relevant_files)
+            return await self.evaluate('query', store, query, message.payload.get('row_groups', False))
+
+        @self.message_handler('query_batch')
+        @ensure_json_output
+        async def query_batch_handler(message: TCPMessage):
+            return await self.evaluate('query_batch', message.payload['queries'])
+
+        @self.stream_handler('query_stream')
+        async def query_stream_handler(message: TCPMessage):
+            store = message.payload['store']
+            query = message.payload['query']
+            async for chunk in self.evaluate_chunks('query_chunks', store, query,
+                                                    message.payload.get('row_groups', False),
+                                                    message.payload.get('chunk_size')):
+                yield chunk
 
 
 class PetalsServer(AbstractPetalsServer):
-    def __init__(self, host, port, stores_dir):
+    def __init__(self, host, port, stores_dir, **kwargs):
         self.stores_dir = stores_dir
-        super().__init__(host, port)
+        self.segments = {}  # (store, filename) -> SegmentReader
+        super().__init__(host, port, **kwargs)
+
+    def worker_spec(self):
+        return type(self), (self.host, self.port, self.stores_dir), self.options
+
+    def store_version(self, store):
+        # The generator rewrites the store metadata at the end of every run
+        try:
+            return os.stat(Path(self.stores_dir) / 'stores_metadata' / f'{store}.json').st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def unload_data(self):
+        for segment in self.segments.values():
+            segment.close()
+        self.segments = {}
+
+    def recorded_bloom_indexes(self, store):
+        """Paths, relative to stores_dir, of the bloom indexes written by the latest generator run of a store"""
+        try:
+            with open(Path(self.stores_dir) / 'stores_metadata' / f'{store}.json', 'r') as f:
+                metadata = json.load(f)
+        except FileNotFoundError:
+            return set()
+        return {info['bloom_index'] for info in metadata.values() if 'bloom_index' in info}
 
     def load_data(self):
+        self.segments = {}
+        bloom_indexes = {}  # store -> recorded bloom indexes
         for root, _, files in os.walk(self.stores_dir):
             for file in files:
-                if file.endswith('.pickle'):
-                    path = Path(root) / file
+                path = Path(root) / file
+                if file.endswith(SEGMENT_SUFFIX):
+                    store = path.parts[-2]
+                    filename = path.stem
+                    segment = SegmentReader(path)
+                    self.segments[(store, filename)] = segment
+                    for column in segment.columns:
+                        self.register_filter(store, filename, column)
+                    if segment.row_groups:
+                        self.register_row_group_filters(store, filename, segment.row_group_count(),
+                                                        segment.row_groups)
+                elif file.endswith(BLOOM_INDEX_SUFFIX):
+                    # A leftover index of an older run would not match the filters
+                    store = path.parts[-2]
+                    if store not in bloom_indexes:
+                        bloom_indexes[store] = self.recorded_bloom_indexes(store)
+                    if os.path.relpath(path, self.stores_dir) in bloom_indexes[store]:
+                        self.register_bloom_index(store, path.stem, BitSlicedBloomIndex.load(path))
+                elif file.endswith('.pickle'):
                     store = path.parts[-3]
                     filename = path.parts[-2]
                     column = path.stem
-                    self.data.insert([store, filename, column], None)
+                    self.register_filter(store, filename, column)
 
     def load_raw_data(self, keys):
-        store, filename, column = keys
+        store, filename, column, *row_group = keys
+        segment = self.segments.get((store, filename))
+        if segment is not None:
+            return segment.read(column, *row_group)
+
         path = Path(self.stores_dir) / store / filename / f"{column}.pickle"
         with open(path, 'rb') as f:
             data = pickle.load(f)
@@ -102,30 +690,153 @@ class PetalsServer(AbstractPetalsServer):
 
 
 class S3PetalsServer(AbstractPetalsServer):
-    def __init__(self, host, port, s3_bucket):
+    """
+    Serves the pickled filters of an S3 bucket, laid out like stores_dir: <store>/<file>/<column>.pickle,
+    optionally under a key prefix.
+
+    The bucket is listed page by page at load time, keeping the ETag of every filter. While a rule tests its
+    files, the filters of the next PREFETCH_WINDOW ones are fetched concurrently on a pool of fetch_workers
+    threads, and added to the filter cache. A filter requested again while it is being fetched waits for that
+    fetch instead of issuing another.
+    With cache_dir, fetched filters are also kept on disk under their ETag, so they are only downloaded
+    again once they changed, including across restarts.
+    The stores are reloaded when the store metadata the generator writes, stores_metadata/<store>.json under
+    the prefix, changed; it is checked at most every VERSION_CHECK_INTERVAL seconds.
+
+    s3_client defaults to boto3.client('s3'); any object with list_objects_v2 and get_object works, such as
+    a local stand-in in tests. Query worker processes always build the default client.
+    """
+
+    FETCH_WORKERS = 16
+    PREFETCH_WINDOW = 64  # filters fetched ahead of the one being tested, bounds the filters held at once
+    VERSION_CHECK_INTERVAL = 30  # seconds a store version is trusted before the bucket is listed again
+
+    def __init__(self, host, port, s3_bucket, s3_client=None, prefix='', cache_dir=None, fetch_workers=None,
+                 **kwargs):
+        if s3_client is None:
+            if boto3 is None:
+                raise ImportError('S3PetalsServer requires boto3 unless it is given an S3 client')
+            s3_client = boto3.client('s3')
         self.s3_bucket = s3_bucket
-        self.s3_client = boto3.client('s3')
-        super().__init__(host, port)
+        self.s3_client = s3_client
+        self.prefix = prefix
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self.fetch_workers = fetch_workers or self.FETCH_WORKERS
+        self.objects = {}  # filter key -> (object key, ETag)
+        self.fetcher = ThreadPoolExecutor(self.fetch_workers, thread_name_prefix='s3-fetch')
+        self._fetches = {}  # (generation, filter key) -> future of the filter being fetched
+        self._fetches_lock = threading.Lock()
+        self._versions = {}  # store -> (time it was read at, version)
+        super().__init__(host, port, **kwargs)
+
+    def worker_spec(self):
+        return type(self), (self.host, self.port, self.s3_bucket), dict(
+            self.options, prefix=self.prefix, cache_dir=self.cache_dir, fetch_workers=self.fetch_workers)
+
+    def list_objects(self):
+        """Yields every object of the bucket under prefix, following the continuation tokens of the listing"""
+        kwargs = {'Bucket': self.s3_bucket, 'Prefix': self.prefix}
+        while True:
+            response = self.s3_client.list_objects_v2(**kwargs)
+            yield from response.get('Contents', ())
+            if not response.get('IsTruncated'):
+                return
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+    def store_version(self, store):
+        # Every query checks the version, only ask the bucket again once the last answer is old enough
+        now = time.monotonic()
+        checked = self._versions.get(store)
+        if checked is not None and now - checked[0] < self.VERSION_CHECK_INTERVAL:
+            return checked[1]
+
+        # The generator rewrites the store metadata at the end of every run
+        key = '/'.join(part for part in (self.prefix.rstrip('/'), 'stores_metadata', f'{store}.json') if part)
+        response = self.s3_client.list_objects_v2(Bucket=self.s3_bucket, Prefix=key, MaxKeys=1)
+        version = next(((obj.get('ETag'), obj.get('LastModified')) for obj in response.get('Contents', ())
+                        if obj['Key'] == key), None)
+        self._versions[store] = (now, version)
+        return version
 
     def load_data(self):
+        self.objects = {}
+        for obj in self.list_objects():
+            if obj['Key'].endswith('.pickle'):
+                path = Path(obj['Key'])
+                store = path.parts[-3]
+                filename = path.parts[-2]
+                column = path.stem
+                key = self.register_filter(store, filename, column)
+                self.objects[key] = (obj['Key'], obj.get('ETag', '').strip('"'))
+
+    def load_filters(self, keys, batch=None):
+        # Filters are handed over from their fetch, the window keeps them from being evicted before their test
+        window = collections.deque()  # (key, future of its filter, None if it was cached)
+        for key in keys:
+            cached = key in self.filter_cache or (batch is not None and key in batch.filters)
+            window.append((key, None if cached else self.fetch(key)))
+            if len(window) > self.PREFETCH_WINDOW:
+                yield self._take_filter(*window.popleft(), batch)
+        while window:
+            yield self._take_filter(*window.popleft(), batch)
+
+    def _take_filter(self, key, future, batch):
+        if future is None:
+            return self.get_filter(key, batch)
+        filter = future.result()
+        if batch is not None:
+            batch.filters[key] = filter
+        return filter
+
+    def fetch(self, key):
+        """Returns the future of the filter of key, fetching it unless a fetch of key is already running"""
+        generation = self.generation
+        with self._fetches_lock:
+            future = self._fetches.get((generation, key))
+            if future is None:
+                future = self._fetches[(generation, key)] = self.fetcher.submit(
+                    self._fetch, key, self.objects[key], generation)
+        return future
+
+    def _fetch(self, key, obj, generation):
         try:
-            response = self.s3_client.list_objects(Bucket=self.s3_bucket)
-            for file in response['Contents']:
-                if file['Key'].endswith('.pickle'):
-                    path = Path(file['Key'])
-                    store = path.parts[-3]
-                    filename = path.parts[-2]
-                    column = path.stem
-                    self.data.insert([store, filename, column], None)
-        except NoCredentialsError:
-            print("No AWS credentials were found.")
+            filter = create_filter(pickle.loads(self.read_object(*obj)))
+            self.filter_cache.put(key, filter)
+            if generation != self.generation:
+                # A reload cleared the cache, possibly before this filter of the previous stores was added
+                self.filter_cache.invalidate(lambda cached_key: cached_key == key)
+            return filter
+        finally:
+            with self._fetches_lock:
+                del self._fetches[(generation, key)]
 
     def load_raw_data(self, keys):
-        store, filename, column = keys
-        path = f'{store}/{filename}/{column}.pickle'
-        try:
-            s3_object = self.s3_client.get_object(Bucket=self.s3_bucket, Key=path)
-            data = pickle.loads(s3_object['Body'].read())
-            return data
-        except NoCredentialsError:
-            print("No AWS credentials were found.")
+        return self.fetch(keys).result()
+
+    def cache_path(self, object_key, etag):
+        return self.cache_dir / self.s3_bucket / f'{object_key}.{etag}'
+
+    def read_object(self, object_key, etag):
+        """Returns the content of an object, from the disk cache when it holds the version with etag"""
+        if self.cache_dir is not None and etag:
+            try:
+                return self.cache_path(object_key, etag).read_bytes()
+            except FileNotFoundError:
+                pass
+
+        response = self.s3_client.get_object(Bucket=self.s3_bucket, Key=object_key)
+        data = response['Body'].read()
+        etag = response.get('ETag', etag).strip('"')
+        if self.cache_dir is not None and etag:
+            path = self.cache_path(object_key, etag)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Drop the cached versions the object replaced
+            for stale in path.parent.glob(f'{glob.escape(Path(object_key).name)}.*'):
+                stale.unlink(missing_ok=True)
+            with replace_atomically(path) as f:
+                f.write(data)
+        return data
+
+    async def shutdown(self, timeout=10):
+        await super().shutdown(timeout)
+        self.fetcher.shutdown(cancel_futures=True)
@@ -0,0 +1,108 @@
+import json
+from typing import Dict, List, Tuple
+
+from core.filters import OPERATORS
+
+
+class QueryPlanner:
+    """
+    Orders the rules of a condition tree so that the cheapest and most selective rules run first.
+
+    The selectivity of a (store, column, operator) rule is learned from previous evaluations: the fraction of probed
+    files that passed, smoothed with an exponential moving average. The cost of a rule is the number of
+    per-file filters it still has to test, columns answered by a bit-sliced bloom index cost nothing.
+    """
+
+    DEFAULT_SELECTIVITY = 0.5
+    SMOOTHING = 0.2
+
+    def __init__(self, server):
+        self.server = server
+        self.selectivity = {}  # (store, column, operator) -> fraction of probed files that matched
+
+    def record(self, store: str, field: str, probed: int, matched: int, operator: str = '='):
+        if not probed:
+            return
+        observed = matched / probed
+        key = (store, field, operator)
+        previous = self.selectivity.get(key)
+        if previous is None:
+            self.selectivity[key] = observed
+        else:
+            self.selectivity[key] = previous + self.SMOOTHING * (observed - previous)
+
+    def estimate(self, condition: Dict, store: str) -> Tuple[float, int]:
+        """Returns the (selectivity, cost) estimate of a condition"""
+        if 'condition' in condition and 'rules' in condition:
+            estimates = [self.estimate(rule, store) for rule in condition['rules']]
+            cost = sum(rule_cost for _, rule_cost in estimates)
+            selectivity = 1.0
+            if condition['condition'] == 'and':
+                for rule_selectivity, _ in estimates:
+                    selectivity *= rule_selectivity
+                return selectivity, cost
+            for rule_selectivity, _ in estimates:
+                selectivity *= 1.0 - rule_selectivity
+            return 1.0 - selectivity, cost
+
+        field = condition['field']
+        selectivity = self.selectivity.get((store, field, condition.get('operator', '=')), self.DEFAULT_SELECTIVITY)
+        if (store, field) in self.server.bloom_indexes:
+            return selectivity, 0
+        return selectivity, len(self.server.index.get(store, {}).get(field, ()))
+
+    def order(self, condition: Dict, store: str) -> List[Dict]:
+        """
+        Returns the rules of a composite condition in evaluation order.
+
+        AND: most selective first, so later rules only probe the few files left.
+        OR: least selective first, so later rules skip the many files that already matched.
+        Ties are broken by cost.
+        """
+        rules = condition['rules']
+        estimates = [self.estimate(rule, store) for rule in rules]
+        if condition['condition'] == 'and':
+            positions = sorted(range(len(rules)), key=lambda i: estimates[i])
+        else:
+            positions = sorted(range(len(rules)), key=lambda i: (-estimates[i][0], estimates[i][1]))
+        return [rules[i] for i in positions]
+
+
+def normalize_condition(condition: Dict) -> Dict:
+    """
+    Returns the canonical form of a condition tree, used as the query result cache key.
+
+    Operators are lowercased and validated, leaf rules always carry one, nested groups with the same operator
+    are flattened into their parent, single-rule groups are replaced by their rule and rules are sorted.
+    """
+    if 'condition' not in condition or 'rules' not in condition:
+        rule = dict(condition)
+        rule['operator'] = rule.get('operator', '=').lower()
+        if rule['operator'] not in OPERATORS:
+            raise ValueError(f"Unknown operator '{rule['operator']}'")
+        if rule['operator'] == 'between' and not (isinstance(rule.get('value'), (list, tuple))
+                                                  and len(rule['value']) == 2):
+            raise ValueError("'between' expects a [low, high] value")
+        if rule['operator'] == 'in' and not isinstance(rule.get('value'), (list, tuple)):
+            raise ValueError("'in' expects a list of values")
+        return rule
+
+    operator = condition['condition'].lower()
+    rules = []
+    for rule in condition['rules']:
+        rule = normalize_condition(rule)
+        if rule.get('condition') == operator and 'rules' in rule:
+            rules.extend(rule['rules'])
+        else:
+            rules.append(rule)
+
+    if len(rules) == 1:
+        return rules[0]
+
+    rules.sort(key=condition_key)
+    return {'condition': operator, 'rules': rules}
+
+
+def condition_key(condition: Dict) -> str:
+    """Stable string form of a (normalized) condition"""
+    return json.dumps(condition, sort_keys=True, default=str)
@@ -0,0 +1,56 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResultCache:
+    """
+    LRU cache of query results keyed by (store, canonical query), with a time to live.
+
+    Entries of a store are dropped as soon as its filters change, see AbstractPetalsServer.register_filter.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # (store, key) -> (expires_at, result)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, store, key):
+        with self._lock:
+            entry = self._entries.get((store, key))
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[(store, key)]
+                self.misses += 1
+                return None
+            self._entries.move_to_end((store, key))
+            self.hits += 1
+            return entry[1]
+
+    def put(self, store, key, result):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[(store, key)] = (time.monotonic() + self.ttl, result)
+            self._entries.move_to_end((store, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, store=None):
+        """Drops every entry, or only the entries of store"""
+        with self._lock:
+            if store is None:
+                self._entries.clear()
+                return
+            for cache_key in [cache_key for cache_key in self._entries if cache_key[0] == store]:
+                del self._entries[cache_key]
+
+    def stats(self):
+        return {'entries': len(self._entries), 'max_entries': self.max_entries, 'ttl': self.ttl,
+                'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,144 @@
+import json
+import mmap
+import os
+import struct
+from contextlib import contextmanager
+from pathlib import Path
+
+from core.utils import get_filter_classes
+
+SEGMENT_SUFFIX = '.petals'
+SEGMENT_MAGIC = b'PTLS'
+SEGMENT_VERSION = 1
+
+# magic, version, header length
+PREFIX = struct.Struct('<4sHI')
+ALIGNMENT = 8
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+@contextmanager
+def replace_atomically(path):
+    """
+    Opens a temporary file next to path for writing and renames it over path once it is complete.
+
+    Servers may have the previous file memory-mapped: truncating it in place would crash them on their
+    next access, while a rename leaves their mapping on the old inode.
+    """
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    try:
+        with open(tmp_path, 'wb') as f:
+            yield f
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+class SegmentWriter:
+    """
+    Packs every column filter of one data file into a single segment file.
+
+    Layout:
+        magic (4 bytes) | version (uint16) | header length (uint32)
+        header: JSON {"columns": {column: entry}, "row_groups": {column: [entry per row group]}}
+                with entry = {"type", "meta", "offset", "length"}
+        payloads, each aligned on 8 bytes, offsets are relative to the end of the header
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.columns = {}
+        self.row_groups = {}
+        self.payloads = []
+        self.size = 0
+
+    def add(self, column, filter, row_group=None):
+        """Adds the filter of a column, or of one of its row groups (added in row group order)"""
+        meta, payload = filter.to_segment()
+        self.size = align(self.size)
+        entry = {'type': filter.name, 'meta': meta, 'offset': self.size, 'length': len(payload)}
+        if row_group is None:
+            self.columns[column] = entry
+        else:
+            entries = self.row_groups.setdefault(column, [])
+            if row_group != len(entries):
+                raise ValueError(f"Row group {row_group} of column '{column}' added out of order")
+            entries.append(entry)
+        self.payloads.append((self.size, payload))
+        self.size += len(payload)
+
+    def close(self):
+        header = {'columns': self.columns}
+        if self.row_groups:
+            header['row_groups'] = self.row_groups
+        header = json.dumps(header).encode()
+        data_start = align(PREFIX.size + len(header))
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with replace_atomically(self.path) as f:
+            f.write(PREFIX.pack(SEGMENT_MAGIC, SEGMENT_VERSION, len(header)))
+            f.write(header)
+            for offset, payload in self.payloads:
+                f.seek(data_start + offset)
+                f.write(payload)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+
+
+class SegmentReader:
+    """Memory-maps a segment file and builds filters directly on top of the mapped payloads"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._file = open(self.path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, header_length = PREFIX.unpack_from(self._mmap, 0)
+        if magic != SEGMENT_MAGIC:
+            raise ValueError(f'{self.path} is not a filter segment')
+        if version != SEGMENT_VERSION:
+            raise ValueError(f'Unsupported segment version {version} in {self.path}')
+
+        header = json.loads(self._mmap[PREFIX.size:PREFIX.size + header_length])
+        self.columns = header['columns']
+        self.row_groups = header.get('row_groups', {})
+        self._data_start = align(PREFIX.size + header_length)
+        self._view = memoryview(self._mmap)
+
+    def row_group_count(self):
+        """Number of row groups with their own filters, 0 if the segment only has file level filters"""
+        return max((len(entries) for entries in self.row_groups.values()), default=0)
+
+    def read(self, column, row_group=None):
+        entry = self.columns[column] if row_group is None else self.row_groups[column][row_group]
+        filter_classes = get_filter_classes()
+        if entry['type'] not in filter_classes:
+            raise ValueError(f"Unknown filter type: {entry['type']}")
+
+        start = self._data_start + entry['offset']
+        payload = self._view[start:start + entry['length']]
+        return filter_classes[entry['type']].from_segment(entry['meta'], payload)
+
+    def close(self):
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Filters built zero-copy still reference the mapping, it is released with them
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,17 +1,41 @@
 import asyncio
+import base64
+import itertools
 import logging
 import xml.etree.ElementTree as ET
 from abc import ABC, abstractmethod
 
+from core.kv_cache import KVCache
 from core.ttl_dict import TTLDictionary
-from core.utils import parse_message, ensure_json_output, TCPMessage
+from core.utils import FRAME_MAGIC, STREAM_END, PayloadError, encode_response, parse_message, read_frame, ensure_json_output, TCPMessage
 
 
 class TCPServer(ABC):
+    """
+    Dispatches messages to the handlers registered with message_handler.
+
+    Two protocols are served on the same port, told apart by the first bytes of a connection:
+    - XML: one <type format="...">payload</type> document per connection, answered with <type>response</type>;
+    - frames: after FRAME_MAGIC, any number of length-prefixed request frames on a keep-alive connection,
+      each answered with a frame carrying the same request id (see core.utils.read_frame).
+
+    Handlers registered with stream_handler are async generators, only served on framed connections: every
+    chunk they yield is sent as soon as it is produced, then a STREAM_END frame closes the response.
+    """
+
+    READ_TIMEOUT = 10  # seconds to receive a message once it started
+    KEEPALIVE_TIMEOUT = 300  # seconds a framed connection may stay idle between requests
+    READ_SIZE = 64 * 1024
+    MAX_PIPELINED_REQUESTS = 64  # requests of one framed connection processed at once
+
     def __init__(self, host, port):
         self.host = host
         self.port = port
         self.handlers = {}
+        self.stream_handlers = {}
+        self.listener = None
+        self.connections = {}  # task handling an open connection -> its writer
+        self.active_requests = 0
 
     def message_handler(self, message_type):
 
@@ -23,29 +47,53 @@ class TCPServer(ABC):
 
         return decorator
 
+    def stream_handler(self, message_type):
+
+        logging.info(f"\tstream handler : {message_type}")
+
+        def decorator(func):
+            self.stream_handlers[message_type] = func
+            return func
+
+        return decorator
+
     @abstractmethod
     def init_handlers(self):
         pass
 
     async def handle_echo(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        try:
+            prefix = await asyncio.wait_for(reader.readexactly(len(FRAME_MAGIC)), self.READ_TIMEOUT)
+            if prefix == FRAME_MAGIC:
+                await self.handle_frames(reader, writer)
+            else:
+                await self.handle_xml(prefix, reader, writer)
+        except asyncio.TimeoutError:
+            logging.error("Connection timed out")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.connections.pop(task, None)
+            writer.close()
 
-        buffer = ""
+    async def handle_xml(self, buffer, reader, writer):
+        buffer = bytearray(buffer)
+        end_tags = tuple(f"</{message_type}>".encode()
+                         for message_type in itertools.chain(self.handlers, self.stream_handlers))
         while True:
-            try:
-                data = await asyncio.wait_for(reader.read(100), 10)
-                buffer += data.decode()
-
-                # Check if buffer ends with any of the registered message tags
-                if any(buffer.endswith(f"</{message_type}>") for message_type in self.handlers):
-                    break
-
-            except asyncio.TimeoutError:
-                logging.error("Connection timed out")
-                writer.close()
+            data = await asyncio.wait_for(reader.read(self.READ_SIZE), self.READ_TIMEOUT)
+            if not data:
                 return
+            buffer += data
+
+            # Check if buffer ends with any of the registered message tags
+            if buffer.endswith(end_tags):
+                break
 
         try:
-            message = parse_message(buffer)
+            message = parse_message(buffer.decode())
         except ET.ParseError:
             logging.error('Invalid XML format')
             return
@@ -53,20 +101,123 @@ class TCPServer(ABC):
         addr = writer.get_extra_info('peername')
 
         if message.cls in self.handlers:
-            response = await self.handlers[message.cls](message)
+            self.active_requests += 1
+            try:
+                response = await self.handlers[message.cls](message)
+            finally:
+                self.active_requests -= 1
+            if isinstance(response, bytes):
+                response = base64.b64encode(response).decode()
+            writer.write(f"<{message.cls}>{response}</{message.cls}>".encode())
+            logging.info(f"Processed {message.cls} from {addr!r}")
+        elif message.cls in self.stream_handlers:
+            response = encode_response(message.format, {"error": f"{message.cls} requires a framed connection"})
+            if isinstance(response, bytes):
+                response = base64.b64encode(response).decode()
             writer.write(f"<{message.cls}>{response}</{message.cls}>".encode())
-            logging.info(f"Processed {message.cls} from {addr!r}, sent: {response!r}")
 
         await writer.drain()
         logging.info("Closing the connection")
-        writer.close()
 
-    async def run(self):
+    async def handle_frames(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        # Requests are processed concurrently and answered as soon as they complete, a slow one does not hold
+        # back the cheap ones pipelined behind it
+        in_flight = asyncio.Semaphore(self.MAX_PIPELINED_REQUESTS)
+        drain_lock = asyncio.Lock()
+        tasks = set()
+
+        async def send(frame):
+            writer.write(frame)
+            # Also waits for the client to read the previous chunks of a stream
+            async with drain_lock:
+                await writer.drain()
+
+        async def respond(request_id, message):
+            self.active_requests += 1
+            try:
+                if message.cls in self.stream_handlers:
+                    await self.stream(request_id, message, send)
+                else:
+                    response = await self.dispatch(message)
+                    await send(TCPMessage(message.cls, message.format, response).to_frame(request_id))
+            except ConnectionError:
+                pass
+            finally:
+                self.active_requests -= 1
+                in_flight.release()
+
+        try:
+            while True:
+                try:
+                    request_id, message = await asyncio.wait_for(read_frame(reader), self.KEEPALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    logging.info(f"Closing idle connection from {addr!r}")
+                    return
+                except asyncio.IncompleteReadError:
+                    # The client closed the connection
+                    return
+                except PayloadError as e:
+                    # Only this request is lost, the frame was read whole
+                    logging.error(f"Invalid frame from {addr!r}: {e}")
+                    error = encode_response(e.message.format, {"error": str(e)})
+                    await send(TCPMessage(e.message.cls, e.message.format, error).to_frame(e.request_id))
+                    continue
+                except ValueError as e:
+                    logging.error(f"Invalid frame from {addr!r}: {e}")
+                    return
+
+                # Stop reading while too many requests of this connection are running
+                await in_flight.acquire()
+                task = asyncio.create_task(respond(request_id, message))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def dispatch(self, message):
+        """Returns the response of the handler of message, or a JSON error, a framed request is always answered"""
+        if message.cls not in self.handlers:
+            return encode_response(message.format, {"error": f"Unknown message type {message.cls}"})
+        try:
+            return await self.handlers[message.cls](message)
+        except Exception as e:
+            logging.exception(f"Failed to process {message.cls}")
+            return encode_response(message.format, {"error": f"{type(e).__name__}: {e}"})
+
+    async def stream(self, request_id, message, send):
+        """Sends every chunk yielded by the stream handler of message, then the STREAM_END frame"""
+        count = 0
+        try:
+            async for chunk in self.stream_handlers[message.cls](message):
+                await send(TCPMessage(message.cls, message.format,
+                                      encode_response(message.format, chunk)).to_frame(request_id))
+                count += 1
+            end = {"count": count}
+        except ConnectionError:
+            raise
+        except Exception as e:
+            logging.exception(f"Failed to stream {message.cls}")
+            end = {"error": f"{type(e).__name__}: {e}"}
+        await send(TCPMessage(STREAM_END, message.format, encode_response(message.format, end)).to_frame(request_id))
+
+    async def run(self, sock=None, reuse_port=None):
+        """
+        Serves until cancelled, on host and port, or on sock, an already bound socket (see core.supervisor).
+
+        With reuse_port, other processes may listen on the same port and the kernel balances the
+        connections between them (SO_REUSEPORT).
+        """
 
         self.init_handlers()
 
-        server = await asyncio.start_server(
-            self.handle_echo, self.host, self.port)
+        if sock is not None:
+            server = await asyncio.start_server(self.handle_echo, sock=sock)
+        else:
+            server = await asyncio.start_server(
+                self.handle_echo, self.host, self.port, reuse_port=reuse_port)
+        self.listener = server
 
         addr = server.sockets[0].getsockname()
         logging.info(f'Serving on {addr}')
@@ -74,11 +225,40 @@ class TCPServer(ABC):
         async with server:
             await server.serve_forever()
 
+    async def shutdown(self, timeout=10):
+        """
+        Stops accepting connections, waits up to timeout seconds for the requests being processed, then
+        closes every connection. Requests received in the meantime are processed too, idle keep-alive
+        connections are closed without waiting.
+        """
+        if self.listener is not None:
+            self.listener.close()
+        deadline = asyncio.get_running_loop().time() + timeout
+        while self.active_requests and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.05)
+        if self.active_requests:
+            logging.warning(f"Closing connections with {self.active_requests} requests still running")
+
+        connections = dict(self.connections)
+        for writer in connections.values():
+            # Their handlers see the connection closed and return
+            writer.close()
+        if connections:
+            _, running = await asyncio.wait(connections, timeout=1)
+            for task in running:
+                task.cancel()
+
 
 class KVServer(TCPServer):
-    def __init__(self, host, port, expirable_dict_path="kvserver.db", default_ttl=60):
+    HOT_TIER_SIZE = 0  # bytes of hot keys kept in memory in front of sqlite, 0 disables the tier
+
+    def __init__(self, host, port, expirable_dict_path="kvserver.db", default_ttl=60, hot_tier_size=None):
         super().__init__(host, port)
-        self.kv = TTLDictionary(expirable_dict_path, default_ttl)  # default TTL 60 seconds
+        hot_tier_size = self.HOT_TIER_SIZE if hot_tier_size is None else hot_tier_size
+        self.hot_tier = KVCache(hot_tier_size) if hot_tier_size else None
+        # default TTL 60 seconds
+        self.kv = TTLDictionary(expirable_dict_path, default_ttl, cache=self.hot_tier)
+        self.expiration_task = None
 
     def init_handlers(self):
         logging.info("Initializing handlers")
@@ -99,12 +279,48 @@ class KVServer(TCPServer):
             key = message.payload['key']
             value = message.payload['value']
             ttl = message.payload.get('ttl')  # ttl is optional
-            await self.kv.__setitem__(key, value, ttl)
+            # Acknowledge once the write is committed to disk rather than once it is queued
+            durable = message.payload.get('durable', False)
+            try:
+                await self.kv.__setitem__(key, value, ttl, durable)
+            except TypeError as e:
+                return {"error": str(e)}
             return {"response": f"Value set for key {key}"}
 
-    async def run(self):
+        @self.message_handler('kv_mget')
+        @ensure_json_output
+        async def mget_handler(message: TCPMessage):
+            keys = message.payload['keys']
+            values = await self.kv.get_many(keys)
+            return {"response": values, "missing": [key for key in keys if key not in values]}
+
+        @self.message_handler('kv_mset')
+        @ensure_json_output
+        async def mset_handler(message: TCPMessage):
+            # items: [{"key": ..., "value": ..., "ttl": ...}], ttl is optional
+            items = [(item['key'], item['value'], item.get('ttl')) for item in message.payload['items']]
+            try:
+                await self.kv.set_many(items, message.payload.get('durable', False))
+            except TypeError as e:
+                return {"error": str(e)}
+            return {"response": {key: "set" for key, _, _ in items}}
+
+        @self.message_handler('kv_mdelete')
+        @ensure_json_output
+        async def mdelete_handler(message: TCPMessage):
+            deleted = await self.kv.delete_many(message.payload['keys'], message.payload.get('durable', False))
+            return {"response": {key: "deleted" if found else "not found" for key, found in deleted.items()}}
+
+    async def run(self, sock=None, reuse_port=None):
         # Start the expiration loop in the background
-        asyncio.create_task(self.kv.expiration_loop())
+        self.expiration_task = asyncio.create_task(self.kv.expiration_loop())
 
         # Continue as normal
-        await super().run()
+        await super().run(sock, reuse_port)
+
+    async def shutdown(self, timeout=10):
+        await super().shutdown(timeout)
+        if self.expiration_task is not None:
+            self.expiration_task.cancel()
+        # Commits the queued writes
+        await asyncio.get_running_loop().run_in_executor(None, self.kv.close)
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from multiprocessing.connection import wait
+
+
+def _run_worker(server_class, host, port, args, kwargs, sock, shutdown_timeout):
+    # Forked workers inherit the handlers of the supervisor
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    server = server_class(host, port, *args, **kwargs)
+    asyncio.run(_serve(server, sock, shutdown_timeout))
+
+
+async def _serve(server, sock, shutdown_timeout):
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stopping.set)
+        except (NotImplementedError, RuntimeError):
+            # No asyncio signal handlers on Windows, the supervisor terminates the worker instead
+            pass
+
+    serving = asyncio.create_task(server.run(sock=sock, reuse_port=sock is None))
+    stopped = asyncio.create_task(stopping.wait())
+    await asyncio.wait((serving, stopped), return_when=asyncio.FIRST_COMPLETED)
+    if serving.done():
+        # Failed to start, the supervisor restarts the worker
+        stopped.cancel()
+        serving.result()
+        return
+
+    logging.info(f"Worker {os.getpid()} shutting down")
+    await server.shutdown(shutdown_timeout)
+    serving.cancel()
+    await asyncio.gather(serving, return_exceptions=True)
+
+
+class Supervisor:
+    """
+    Runs a server in several worker processes accepting connections on the same port.
+
+    Every worker builds its own server_class(host, port, *args, **kwargs) and evaluates queries with its own
+    GIL. Filter segments and bloom indexes are memory-mapped read-only, so the workers share one copy of
+    them in the page cache; only pickled filters and the caches are per worker.
+
+    Workers listen with SO_REUSEPORT where the platform has it, the kernel balancing connections between
+    them, otherwise they accept on a socket bound by the supervisor. A worker that exits is restarted after
+    RESTART_DELAY seconds. On SIGTERM or SIGINT the supervisor asks every worker to shut down gracefully
+    (see TCPServer.shutdown) and kills the ones still running after shutdown_timeout.
+
+    The workers share the sqlite file of the KV store but not their pending writes: a write is only visible
+    to the other workers once committed, use durable writes to read them from any connection. The hot tier
+    would serve stale values across workers, it cannot be enabled.
+    """
+
+    RESTART_DELAY = 1  # seconds before restarting a worker that exited
+    SHUTDOWN_TIMEOUT = 10  # seconds given to the workers to finish their requests
+
+    def __init__(self, server_class, host, port, args=(), kwargs=None, workers=None, reuse_port=None,
+                 shutdown_timeout=None):
+        kwargs = kwargs or {}
+        if kwargs.get('hot_tier_size'):
+            raise ValueError('The KV hot tier cannot be shared by several worker processes')
+        self.server_class = server_class
+        self.host = host
+        self.port = port
+        self.args = args
+        self.kwargs = kwargs
+        self.workers = workers or os.cpu_count() or 1
+        self.reuse_port = hasattr(socket, 'SO_REUSEPORT') if reuse_port is None else reuse_port
+        self.shutdown_timeout = self.SHUTDOWN_TIMEOUT if shutdown_timeout is None else shutdown_timeout
+        self.processes = []
+        self.sock = None
+        self.stopping = False
+
+    def listen(self):
+        """Binds the socket the workers accept on when they cannot use SO_REUSEPORT"""
+        sock = socket.create_server((self.host, self.port), reuse_port=False)
+        sock.set_inheritable(True)
+        return sock
+
+    def start_worker(self):
+        process = multiprocessing.Process(
+            target=_run_worker, name='petals-worker',
+            args=(self.server_class, self.host, self.port, self.args, self.kwargs, self.sock, self.shutdown_timeout))
+        process.start()
+        logging.info(f"Started worker {process.pid}")
+        return process
+
+    def stop(self, *_):
+        self.stopping = True
+
+    def run(self):
+        """Starts the workers and supervises them until SIGTERM or SIGINT"""
+        previous_handlers = {sig: signal.signal(sig, self.stop) for sig in (signal.SIGTERM, signal.SIGINT)}
+        if not self.reuse_port:
+            self.sock = self.listen()
+        try:
+            self.processes = [self.start_worker() for _ in range(self.workers)]
+            restarts = {}  # index of an exited worker -> time it is restarted at
+            while not self.stopping:
+                sentinels = [process.sentinel for process in self.processes if process.is_alive()]
+                if sentinels:
+                    wait(sentinels, timeout=0.5)
+                else:
+                    time.sleep(0.5)
+                now = time.monotonic()
+                for i, process in enumerate(self.processes):
+                    if self.stopping or process.is_alive():
+                        continue
+                    if i not in restarts:
+                        logging.warning(f"Worker {process.pid} exited with code {process.exitcode}, "
+                                        f"restarting it in {self.RESTART_DELAY}s")
+                        restarts[i] = now + self.RESTART_DELAY
+                    elif restarts[i] <= now:
+                        del restarts[i]
+                        self.processes[i] = self.start_worker()
+        finally:
+            self.shutdown()
+            for sig, handler in previous_handlers.items():
+                signal.signal(sig, handler)
+
+    def shutdown(self):
+        logging.info("Stopping workers")
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + self.shutdown_timeout + 1
+        for process in self.processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logging.warning(f"Killing worker {process.pid}")
+                process.kill()
+                process.join()
+        self.processes = []
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
@@ -1,56 +1,330 @@
+import heapq
+import queue
 import sqlite3
-from datetime import datetime, timedelta
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import asyncio
 
 
+def now_ms():
+    """Current time as integer epoch milliseconds, the unit of expires_at"""
+    return time.time_ns() // 1000000
+
+
+def check_storable(key, value):
+    """Raises TypeError unless sqlite can store key and value: None, str, bytes, float or a 64 bit int"""
+    for item in (key, value):
+        if not (item is None or isinstance(item, (str, bytes, float))
+                or (isinstance(item, int) and -2 ** 63 <= item < 2 ** 63)):
+            raise TypeError(f'Cannot store a value of type {type(item).__name__}')
+
+
+class _Write:
+    """A write queued for the writer thread, with the values readers see until it is committed"""
+
+    def __init__(self, sql, params, many=False, entries=None):
+        self.sql = sql
+        self.params = params
+        self.many = many
+        self.entries = entries or {}  # key -> (value, expires_at), value is None for a deletion
+        self.done = Future()
+
+
 class TTLDictionary:
-    def __init__(self, db_path, default_ttl):
-        self.conn = sqlite3.connect(db_path)
-        self.cursor = self.conn.cursor()
+    """
+    sqlite backed dictionary whose entries expire after a time to live.
+
+    Writes are queued to a single writer thread, which commits everything queued within commit_interval
+    seconds in one transaction. A write is acknowledged once queued, or once committed to disk with
+    durable=True. Until then, reads see it from the pending writes. Reads run on a small thread pool with
+    one connection per thread, the database is in WAL mode so they never wait for the writer.
+
+    Expiry times are integer epoch milliseconds, indexed. A heap of (expires_at, key) orders the keys to
+    evict: every key written is pushed on it, and the keys already in the database are loaded from the index
+    EXPIRY_PRELOAD at a time, in expiry order. The expiration loop deletes due keys EXPIRY_BATCH at a time.
+    Only the latest expiry of a key is live, the entries of rewritten or deleted keys are skipped, and the
+    heap is rebuilt once they outnumber the live ones.
+
+    An optional cache (core.kv_cache.KVCache) serves hot keys without any SQL, writes go through it.
+    """
+
+    COMMIT_INTERVAL = 0.005  # seconds
+    MAX_BATCH = 10000  # writes per transaction
+    MAX_VARIABLES = 900  # keys per IN (...) lookup, below the sqlite limit on bound parameters
+    READ_THREADS = 4
+    EXPIRY_INTERVAL = 1  # seconds between evictions when no batch is full
+    EXPIRY_BATCH = 1000  # keys deleted per eviction
+    EXPIRY_PRELOAD = 100000  # keys of the database loaded in the expiry heap at a time
+
+    def __init__(self, db_path, default_ttl, commit_interval=None, cache=None):
+        self.db_path = db_path
         self.default_ttl = default_ttl
+        self.commit_interval = self.COMMIT_INTERVAL if commit_interval is None else commit_interval
+        self.cache = cache
+        # Incremented by every write, a value read from the database is only cached if none happened meanwhile
+        self._write_count = 0
+
+        conn = self._connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS expirable_dict
+                            (key TEXT PRIMARY KEY,
+                             value TEXT,
+                             expires_at INTEGER)''')
+        # Databases written before expiry was stored as epoch milliseconds hold local timestamp strings
+        conn.execute("UPDATE expirable_dict SET expires_at = CAST(strftime('%s', expires_at, 'utc') AS INTEGER) * 1000 "
+                     "WHERE typeof(expires_at) = 'text'")
+        conn.execute('CREATE INDEX IF NOT EXISTS expirable_dict_expires_at ON expirable_dict (expires_at)')
+        conn.commit()
+        conn.close()
+
+        self._expiry = []  # heap of (expires_at, key), entries not matching _expiry_at are stale
+        self._expiry_at = {}  # key -> expires_at of its live entry in the expiry heap
+        self._expiry_horizon = 0  # keys of the database expiring after it are not in the heap, None if all are
+
+        self._pending = {}  # key -> latest uncommitted _Write of key
+        self._pending_lock = threading.Lock()
+        self._writes = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name='ttl-dict-writer', daemon=True)
+        self._writer.start()
+        self._local = threading.local()
+        self._readers = ThreadPoolExecutor(self.READ_THREADS, thread_name_prefix='ttl-dict-reader')
+        self._closed = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        # In WAL mode a FULL commit is durable once it returns
+        conn.execute('PRAGMA synchronous=FULL')
+        return conn
+
+    def _write_loop(self):
+        conn = self._connect()
+        while True:
+            batch = [self._writes.get()]
+            deadline = time.monotonic() + self.commit_interval
+            while len(batch) < self.MAX_BATCH and batch[-1] is not None:
+                try:
+                    batch.append(self._writes.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+
+            writes = [write for write in batch if write is not None]
+            errors = self._commit(conn, writes)
+
+            with self._pending_lock:
+                for write in writes:
+                    for key in write.entries:
+                        if self._pending.get(key) is write:
+                            del self._pending[key]
+                            if write in errors and self.cache is not None:
+                                # The cached value was never stored
+                                self.cache.delete(key)
+            for write in writes:
+                if write in errors:
+                    write.done.set_exception(errors[write])
+                else:
+                    write.done.set_result(None)
+
+            if batch[-1] is None:
+                conn.close()
+                return
 
-        self.cursor.execute('''CREATE TABLE IF NOT EXISTS expirable_dict 
-                            (key TEXT PRIMARY KEY, 
-                             value TEXT, 
-                             expires_at TIMESTAMP)''')
+    @staticmethod
+    def _commit(conn, writes):
+        """
+        Commits writes in one transaction. If it fails, commits them again one transaction each, so that only
+        the failing writes are lost. Returns {write: error} of the failed ones.
+        """
+        def execute(write):
+            (conn.executemany if write.many else conn.execute)(write.sql, write.params)
 
-    async def __setitem__(self, key, value, ttl=None):
+        try:
+            with conn:
+                for write in writes:
+                    execute(write)
+            return {}
+        except Exception as e:
+            # Anything raised here would stop the writer thread
+            if len(writes) == 1:
+                return {writes[0]: e}
+
+        errors = {}
+        for write in writes:
+            try:
+                with conn:
+                    execute(write)
+            except Exception as e:
+                errors[write] = e
+        return errors
+
+    def _queue(self, write):
+        if self._closed:
+            raise RuntimeError('TTLDictionary is closed')
+        if write.entries:
+            with self._pending_lock:
+                for key in write.entries:
+                    self._pending[key] = write
+        self._writes.put(write)
+        return write.done
+
+    async def _wait(self, future):
+        await asyncio.wrap_future(future)
+
+    async def _read(self, sql, params=()):
+        def read():
+            conn = getattr(self._local, 'conn', None)
+            if conn is None:
+                conn = self._local.conn = self._connect()
+            return conn.execute(sql, params).fetchall()
+
+        return await asyncio.get_running_loop().run_in_executor(self._readers, read)
+
+    async def flush(self):
+        """Waits until every write queued so far is committed"""
+        await self._wait(self._queue(_Write('SELECT 1', ())))
+
+    async def __setitem__(self, key, value, ttl=None, durable=False):
+        check_storable(key, value)
         if ttl is None:
             ttl = self.default_ttl
-        expires_at = datetime.now() + timedelta(seconds=ttl)
-        self.cursor.execute("INSERT OR REPLACE INTO expirable_dict VALUES (?, ?, ?)", (key, value, expires_at))
-        self.conn.commit()
+        expires_at = now_ms() + int(ttl * 1000)
+        self._push_expiry(key, expires_at)
+        self._write_count += 1
+        if self.cache is not None:
+            self.cache.put(key, value, expires_at)
+        done = self._queue(_Write("INSERT OR REPLACE INTO expirable_dict VALUES (?, ?, ?)", (key, value, expires_at),
+                                  entries={key: (value, expires_at)}))
+        if durable:
+            await self._wait(done)
+
+    async def set_many(self, items, durable=False):
+        """Sets (key, value, ttl) items in a single statement, a ttl of None is the default one"""
+        items = list(items)
+        for key, value, _ in items:
+            # Reject the whole batch before queueing anything
+            check_storable(key, value)
+        now = now_ms()
+        rows = []
+        entries = {}
+        for key, value, ttl in items:
+            expires_at = now + int((self.default_ttl if ttl is None else ttl) * 1000)
+            self._push_expiry(key, expires_at)
+            rows.append((key, value, expires_at))
+            entries[key] = (value, expires_at)
+            if self.cache is not None:
+                self.cache.put(key, value, expires_at)
+        self._write_count += 1
+        done = self._queue(_Write("INSERT OR REPLACE INTO expirable_dict VALUES (?, ?, ?)", rows, many=True,
+                                  entries=entries))
+        if durable:
+            await self._wait(done)
+
+    def _pending_entry(self, key):
+        """Returns (found, value, expires_at) from the uncommitted writes, found is None when there are none"""
+        with self._pending_lock:
+            write = self._pending.get(key)
+        if write is None:
+            return None, None, None
+        value, expires_at = write.entries[key]
+        return value is not None, value, expires_at
 
     async def __getitem__(self, key):
-        result = self.cursor.execute("SELECT value, expires_at FROM expirable_dict WHERE key=?", (key,)).fetchone()
-        if result is None:
+        if self.cache is not None:
+            entry = self.cache.get(key)
+            if entry is not None:
+                return entry[0]
+
+        found, value, expires_at = self._pending_entry(key)
+        if found is None:
+            write_count = self._write_count
+            rows = await self._read("SELECT value, expires_at FROM expirable_dict WHERE key=?", (key,))
+            if not rows:
+                raise KeyError(key)
+            value, expires_at = rows[0]
+            if self.cache is not None and write_count == self._write_count:
+                self.cache.put(key, value, expires_at)
+        elif not found:
             raise KeyError(key)
-        value, expires_at = result
-        if datetime.strptime(expires_at, '%Y-%m-%d %H:%M:%S.%f') < datetime.now():
-            self.cursor.execute("DELETE FROM expirable_dict WHERE key=?", (key,))
-            self.conn.commit()
+
+        now = now_ms()
+        if expires_at <= now:
+            self._queue(_Write("DELETE FROM expirable_dict WHERE key=? AND expires_at<=?", (key, now)))
             raise KeyError(key)
         return value
 
+    async def get_many(self, keys):
+        """Returns {key: value} for the keys that are set and not expired, looked up IN (...) in batches"""
+        now = now_ms()
+        values = {}
+        lookup = []
+        for key in dict.fromkeys(keys):
+            entry = self.cache.get(key) if self.cache is not None else None
+            if entry is not None:
+                values[key] = entry[0]
+                continue
+            found, value, expires_at = self._pending_entry(key)
+            if found is None:
+                lookup.append(key)
+            elif found and expires_at > now:
+                values[key] = value
+
+        write_count = self._write_count
+        for start in range(0, len(lookup), self.MAX_VARIABLES):
+            chunk = lookup[start:start + self.MAX_VARIABLES]
+            rows = await self._read("SELECT key, value, expires_at FROM expirable_dict "
+                                    f"WHERE key IN ({', '.join('?' * len(chunk))})", chunk)
+            for key, value, expires_at in rows:
+                if expires_at > now:
+                    values[key] = value
+                    if self.cache is not None and write_count == self._write_count:
+                        self.cache.put(key, value, expires_at)
+        return values
+
     async def __contains__(self, key):
-        result = self.cursor.execute("SELECT 1 FROM expirable_dict WHERE key=?", (key,)).fetchone()
-        return result is not None
+        found, _, _ = self._pending_entry(key)
+        if found is not None:
+            return found
+        return bool(await self._read("SELECT 1 FROM expirable_dict WHERE key=?", (key,)))
 
-    async def __delitem__(self, key):
-        if key not in self:
+    async def __delitem__(self, key, durable=False):
+        if not await self.__contains__(key):
             raise KeyError(key)
-        self.cursor.execute("DELETE FROM expirable_dict WHERE key=?", (key,))
-        self.conn.commit()
+        self._write_count += 1
+        self._expiry_at.pop(key, None)
+        if self.cache is not None:
+            self.cache.delete(key)
+        done = self._queue(_Write("DELETE FROM expirable_dict WHERE key=?", (key,), entries={key: (None, None)}))
+        if durable:
+            await self._wait(done)
+
+    async def delete_many(self, keys, durable=False):
+        """Deletes keys in a single statement and returns {key: whether it was set}"""
+        keys = list(dict.fromkeys(keys))
+        existing = set(await self.get_many(keys))
+        self._write_count += 1
+        for key in keys:
+            self._expiry_at.pop(key, None)
+        if self.cache is not None:
+            for key in keys:
+                self.cache.delete(key)
+        done = self._queue(_Write("DELETE FROM expirable_dict WHERE key=?", [(key,) for key in keys], many=True,
+                                  entries={key: (None, None) for key in keys}))
+        if durable:
+            await self._wait(done)
+        return {key: key in existing for key in keys}
 
     async def keys(self):
-        return [row[0] for row in self.cursor.execute("SELECT key FROM expirable_dict")]
+        await self.flush()
+        return [row[0] for row in await self._read("SELECT key FROM expirable_dict")]
 
     async def values(self):
-        return [row[0] for row in self.cursor.execute("SELECT value FROM expirable_dict")]
+        await self.flush()
+        return [row[0] for row in await self._read("SELECT value FROM expirable_dict")]
 
     async def items(self):
-        return [(row[0], row[1]) for row in self.cursor.execute("SELECT key, value FROM expirable_dict")]
+        await self.flush()
+        return [(row[0], row[1]) for row in await self._read("SELECT key, value FROM expirable_dict")]
 
     async def get(self, key, default=None):
         try:
@@ -59,14 +333,67 @@ class TTLDictionary:
             return default
 
     async def clear(self):
-        self.cursor.execute("DELETE FROM expirable_dict")
-        self.conn.commit()
+        done = self._queue(_Write("DELETE FROM expirable_dict", ()))
+        with self._pending_lock:
+            self._pending.clear()
+        self._write_count += 1
+        self._expiry = []
+        self._expiry_at = {}
+        if self.cache is not None:
+            self.cache.clear()
+        await self._wait(done)
 
     async def expiration_loop(self):
         while True:
-            self.cursor.execute("DELETE FROM expirable_dict WHERE expires_at<?", (datetime.now(),))
-            self.conn.commit()
-            await asyncio.sleep(1)  # sleep for a while before next cleanup
+            if self._expiry_horizon is not None and (not self._expiry or self._expiry[0][0] > self._expiry_horizon):
+                await self._load_expiry()
+
+            evicted = self.evict_expired()
+            # Keep going while the backlog fills whole batches, otherwise sleep for a while before next cleanup
+            await asyncio.sleep(0 if evicted == self.EXPIRY_BATCH else self.EXPIRY_INTERVAL)
+
+    async def _load_expiry(self):
+        """Pushes the next EXPIRY_PRELOAD keys of the database, in expiry order, on the expiry heap"""
+        rows = await self._read("SELECT expires_at, key FROM expirable_dict WHERE expires_at>=? "
+                                "ORDER BY expires_at LIMIT ?", (self._expiry_horizon, self.EXPIRY_PRELOAD))
+        for expires_at, key in rows:
+            # Skips the keys already loaded, and the ones written since with a later expiry
+            if expires_at > self._expiry_at.get(key, -1):
+                self._push_expiry(key, expires_at)
+        # Keys expiring at the same time as the last one may be cut off, they are loaded again with the next ones
+        self._expiry_horizon = rows[-1][0] if len(rows) == self.EXPIRY_PRELOAD else None
+
+    def evict_expired(self):
+        """Deletes up to EXPIRY_BATCH due keys of the expiry heap and returns how many were due"""
+        now = now_ms()
+        due = []
+        while self._expiry and self._expiry[0][0] <= now and len(due) < self.EXPIRY_BATCH:
+            expires_at, key = heapq.heappop(self._expiry)
+            if self._expiry_at.get(key) != expires_at:
+                # Superseded by a later write or deleted
+                continue
+            del self._expiry_at[key]
+            due.append((key, now))
+        if due:
+            self._queue(_Write("DELETE FROM expirable_dict WHERE key=? AND expires_at<=?", due, many=True))
+        return len(due)
+
+    def _push_expiry(self, key, expires_at):
+        self._expiry_at[key] = expires_at
+        heapq.heappush(self._expiry, (expires_at, key))
+        if len(self._expiry) > 2 * len(self._expiry_at) + self.EXPIRY_BATCH:
+            # Rewritten keys left too many stale entries, keep one per key
+            self._expiry = [(expires_at, key) for key, expires_at in self._expiry_at.items()]
+            heapq.heapify(self._expiry)
 
     def start_expiration_loop(self):
-        asyncio.run(self.expiration_loop())
\ No newline at end of file
+        asyncio.run(self.expiration_loop())
+
+    def close(self):
+        """Commits the queued writes and stops the writer thread"""
+        if self._closed:
+            return
+        self._closed = True
+        self._writes.put(None)
+        self._writer.join()
+        self._readers.shutdown()
@@ -2,11 +2,16 @@ import base64
 import functools
 import inspect
 import json
+import struct
 from xml.sax.saxutils import escape
 import xml.etree.ElementTree as ET
 
+from core import codec
 from core.filters import Filter
 
+# Payload format encoding dicts, lists, strings and numbers with core.codec instead of JSON
+BINARY_FORMAT = "binary"
+
 
 def cache(func):
     cache = {}
@@ -20,13 +25,21 @@ def cache(func):
     return wrapper
 
 
+def encode_response(message_format, result):
+    """Encodes a handler result as JSON, or with core.codec when the request used the binary format"""
+    if message_format == BINARY_FORMAT:
+        return codec.encode(result)
+    return json.dumps(result)
+
+
 def ensure_json_output(func):
     @functools.wraps(func)
     async def wrapper(*args, **kwargs):
         result = await func(*args, **kwargs)
         if isinstance(result, str):
             result = {"response": result}  # Convert non-dict strings to JSON format
-        return json.dumps(result)
+        # Handlers take the message last, the response uses its format
+        return encode_response(getattr(args[-1], 'format', None) if args else None, result)
 
     return wrapper
 
@@ -40,6 +53,17 @@ def get_filter_classes():
     # Create a mapping from names to classes
     return {cls.name: cls for cls in subclasses}
 
+# A connection starting with FRAME_MAGIC exchanges length-prefixed frames instead of a single XML document:
+#   payload length, request id, message type length, format length (FRAME_HEADER)
+#   message type, format, payload
+FRAME_MAGIC = b'PTF1'
+FRAME_HEADER = struct.Struct('!IIBB')
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+# A streamed response is any number of frames of the request's message type, each carrying a chunk of the
+# result, followed by a frame of this type with the same request id: {"count": chunks} or {"error": ...}
+STREAM_END = "stream_end"
+
+
 class TCPMessage:
 
     def __init__(self, cls, message_format, payload):
@@ -50,9 +74,33 @@ class TCPMessage:
     def to_xml(self):
         root = ET.Element(self.cls)
         root.set("format", self.format)
-        root.text = escape(self.payload)  # ensure that payload is properly escaped
+        payload = self.payload
+        if isinstance(payload, bytes):
+            # Binary payloads travel base64 encoded in XML
+            payload = base64.b64encode(payload).decode()
+        root.text = escape(payload)  # ensure that payload is properly escaped
         return ET.tostring(root, encoding="unicode")
 
+    def to_frame(self, request_id=0):
+        cls = self.cls.encode()
+        message_format = self.format.encode()
+        payload = self.payload if isinstance(self.payload, bytes) else self.payload.encode()
+        header = FRAME_HEADER.pack(len(payload), request_id, len(cls), len(message_format))
+        return b''.join((header, cls, message_format, payload))
+
+
+def decode_payload(message_format, payload):
+    """Parses a payload, bytes read from a frame or text read from XML, based on its format"""
+    if message_format == BINARY_FORMAT:
+        return codec.decode(payload if isinstance(payload, (bytes, memoryview)) else base64.b64decode(payload))
+    if isinstance(payload, (bytes, memoryview)):
+        payload = str(payload, 'utf-8')
+    if message_format == "json":
+        payload = json.loads(payload)
+    elif message_format == "base64":
+        payload = base64.b64decode(payload).decode('utf-8')
+    return payload
+
 
 def parse_message(xml_string):
     root = ET.fromstring(xml_string)
@@ -61,10 +109,36 @@ def parse_message(xml_string):
     message_format = root.get("format")
     payload = root.text.strip()
 
-    # Parse the payload based on its format
-    if message_format == "json":
-        payload = json.loads(payload)
-    elif message_format == "base64":
-        payload = base64.b64decode(payload).decode('utf-8')
+    return TCPMessage(cls, message_format, decode_payload(message_format, payload))
+
+
+class PayloadError(ValueError):
+    """A frame was read whole but its payload could not be decoded, the connection can go on"""
+
+    def __init__(self, request_id, message, error):
+        super().__init__(f"Invalid {message.format} payload: {error}")
+        self.request_id = request_id
+        self.message = message  # TCPMessage without payload
+
+
+async def read_frame(reader):
+    """
+    Reads one frame from an asyncio stream and returns (request id, TCPMessage).
+
+    Raises asyncio.IncompleteReadError when the connection is closed, ValueError on an oversized frame and
+    PayloadError on a payload that does not decode.
+    """
+    length, request_id, cls_length, format_length = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f'Frame of {length} bytes exceeds the {MAX_FRAME_SIZE} bytes limit')
 
-    return TCPMessage(cls, message_format, payload)
+    data = await reader.readexactly(cls_length + format_length + length)
+    cls = data[:cls_length].decode()
+    message_format = data[cls_length:cls_length + format_length].decode()
+    payload = memoryview(data)[cls_length + format_length:]
+    try:
+        payload = decode_payload(message_format, payload)
+    except Exception as e:
+        # Malformed payloads raise ValueError, but also IndexError, TypeError or struct.error from core.codec
+        raise PayloadError(request_id, TCPMessage(cls, message_format, None), e) from e
+    return request_id, TCPMessage(cls, message_format, payload)
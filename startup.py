@@ -3,19 +3,28 @@ import logging
 import warnings
 warnings.filterwarnings("ignore")
 from core.petals import PetalsServer
+from core.supervisor import Supervisor
 from core.utils import ensure_json_output, TCPMessage
 
 logging.basicConfig(level=logging.INFO)
 
-server = PetalsServer('127.0.0.1', 8888, r"C:\Users\medzi\Desktop\bnp\petals-framework\draft\stores")
+HOST, PORT = '127.0.0.1', 8888
+STORES_DIR = r"C:\Users\medzi\Desktop\bnp\petals-framework\draft\stores"
+# More than 1 runs a supervisor forking that many server processes on the same port
+WORKERS = 1
 
 
 if __name__ == "__main__":
-    try:
-        asyncio.run(server.run())
-    except KeyboardInterrupt:
-        logging.info("Server stopping...")
-    except Exception as e:
-        logging.exception("Unexpected exception")
-    finally:
+    if WORKERS > 1:
+        Supervisor(PetalsServer, HOST, PORT, args=(STORES_DIR,), workers=WORKERS).run()
         logging.info("Server shutdown.")
+    else:
+        server = PetalsServer(HOST, PORT, STORES_DIR)
+        try:
+            asyncio.run(server.run())
+        except KeyboardInterrupt:
+            logging.info("Server stopping...")
+        except Exception as e:
+            logging.exception("Unexpected exception")
+        finally:
+            logging.info("Server shutdown.")
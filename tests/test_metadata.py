@@ -0,0 +1,50 @@
+import pandas as pd
+
+from core.metadata import ParquetFilterGenerator
+from core.segment import SegmentReader
+
+
+def write_parquet(path, accounts):
+    pd.DataFrame({'account': accounts, 'amount': range(len(accounts))}).to_parquet(path, row_group_size=30)
+
+
+def generate(data_dir, filter_dir, account_strategy='bloom', **kwargs):
+    generator = ParquetFilterGenerator(data_dir, 'store', filter_dir, **kwargs)
+    generator.override_filter_strategy('account', account_strategy)
+    generator.override_filter_strategy('amount', 'range')
+    rebuilt = []
+    generate_file_filters = generator.generate_file_filters
+    generator.generate_file_filters = lambda path: rebuilt.append(path.name) or generate_file_filters(path)
+    generator.generate_filters()
+    return rebuilt
+
+
+def test_appended_row_groups_extend_segment_filters(tmp_path):
+    data_dir, filter_dir = tmp_path / 'data', tmp_path / 'filters'
+    data_dir.mkdir()
+    accounts = [f'acc{i}' for i in range(90)]
+    write_parquet(data_dir / 'part.parquet', accounts)
+    assert generate(data_dir, filter_dir) == ['part.parquet']
+
+    # A new row group, the bloom filter is sized for the first values but takes one more
+    write_parquet(data_dir / 'part.parquet', accounts + accounts[:29] + ['new'])
+    assert generate(data_dir, filter_dir) == []
+
+    with SegmentReader(filter_dir / 'store' / 'part.petals') as segment:
+        assert segment.read('account').test('new')
+        assert segment.read('amount').max == 119
+
+
+def test_changed_settings_rebuild_filters(tmp_path):
+    data_dir, filter_dir = tmp_path / 'data', tmp_path / 'filters'
+    data_dir.mkdir()
+    write_parquet(data_dir / 'part.parquet', [f'acc{i}' for i in range(90)])
+    assert generate(data_dir, filter_dir) == ['part.parquet']
+    assert generate(data_dir, filter_dir) == []
+
+    assert generate(data_dir, filter_dir, account_strategy='set_membership') == ['part.parquet']
+    assert generate(data_dir, filter_dir, account_strategy='set_membership') == []
+
+    # The segment of the previous format is not left behind
+    assert generate(data_dir, filter_dir, account_strategy='set_membership', filter_format='pickle') == ['part.parquet']
+    assert sorted(path.name for path in (filter_dir / 'store').iterdir()) == ['part']